@@ -0,0 +1,113 @@
+import time
+import numpy
+
+
+"""Continuous acquisition of B2901A measurement data while a sweep runs.  The
+instrument stores each measurement in its trace buffer; TraceStream reads
+the new entries periodically, so results are available during long runs,
+while only a bounded amount is held in memory."""
+
+
+class RingBuffer:
+    """Fixed-size store of the most recent rows of measurement data."""
+    def __init__(self, rows, columns):
+        self.data = numpy.zeros((rows, columns))
+        self.count = 0                                  #total rows ever appended
+
+    def append(self, block):
+        """Appends the rows of 2-D array block, overwriting the oldest."""
+        rows = len(self.data)
+        if len(block) > rows:                           #only the newest can be kept
+            self.count = self.count + len(block) - rows
+            block = block[-rows:]
+        start = self.count % rows
+        first = min(len(block), rows - start)
+        self.data[start:start + first] = block[:first]
+        self.data[:len(block) - first] = block[first:]  #wrap around
+        self.count = self.count + len(block)
+
+    def latest(self, n=None):
+        """Returns (a copy of) the newest n rows held, oldest first."""
+        held = min(self.count, len(self.data))
+        if n is None or n > held:
+            n = held
+        end = self.count % len(self.data)
+        return self.data[numpy.arange(end - n, end) % len(self.data)]
+
+
+class TraceStream:
+    """Streams measurement data from a B2901A's trace buffer during sweeps.
+    Call begin() just before each initiate(wait=False), then consume stream()
+    (or call wait()) to pick up new points until the sweep completes.  (With
+    *WAI, the instrument wouldn't answer until the sweep had ended.)  Each
+    block of new points is a NumPy array with one row per point and one
+    column per element; blocks are kept in a RingBuffer of ringSize rows, appended to log
+    (a measurementlog.MeasurementLog with the columns given by columns()) if
+    given, and passed to callback if given."""
+    def __init__(self, smu, elements=("VOLT", "CURR", "TIME", "STAT"), ringSize=100000,
+                 log=None, callback=None, interval=0.1):
+        self.smu = smu
+        self.elements = elements
+        self.ring = RingBuffer(ringSize, len(elements))
+        self.log = log
+        self.callback = callback
+        self.interval = interval                        #seconds between reads of the buffer
+        self.offset = 0                                 #trace entries already read
+        self.points = 0                                 #total points acquired
+
+    def columns(self):
+        """Returns (name, dtype) pairs for a MeasurementLog of this stream's data:
+        one column per element, plus the sweep number."""
+        return [(name, "uint32" if name == "STAT" else "float64") for name in self.elements] + [("SWEEP", "uint32")]
+
+    def begin(self, label=None):
+        """Clears the trace buffer and arms it for the next sweep.  label (e.g.
+        the waveform's content hash) is recorded in the log for the sweep."""
+        self.smu.enableTraceBuffer(self.smu.maxTracePoints)
+        self.offset = 0
+        if self.log is not None:
+            self.log.startSweep(label)
+
+    def drain(self):
+        """Reads any entries stored since the last read.  Returns them as a
+        2-D array, or None if there were none."""
+        available = self.smu.tracePoints()
+        if available <= self.offset:
+            return None
+        block = self.smu.readTrace(self.offset, available - self.offset, self.elements)
+        self.offset = available
+        self.points = self.points + len(block)
+        self.ring.append(block)
+        if self.log is not None:
+            self.log.append({name: block[:, k] for k, name in enumerate(self.elements)})
+        if self.callback is not None:
+            self.callback(block)
+        return block
+
+    def stream(self, estimate=0, timeout=None):
+        """Generator yielding blocks of new points every interval seconds until
+        the monitored sweep completes (see Instrument.done()), then any
+        remaining points.  Raises TimeoutError after timeout seconds."""
+        start = time.perf_counter()
+        if self.smu.mock:
+            time.sleep(estimate)                        #nothing to read
+            self.smu.lastWait = (time.perf_counter() - start, estimate)
+            return
+        while True:
+            finished = self.smu.done()
+            block = self.drain()
+            if block is not None:
+                yield block
+            if finished:
+                break
+            if timeout is not None and time.perf_counter() - start > timeout:
+                raise TimeoutError("Sweep did not complete within " + str(timeout) + " s")
+            time.sleep(self.interval)
+        self.smu.lastWait = (time.perf_counter() - start, estimate)
+
+    def wait(self, estimate=0, timeout=None):
+        """Drop-in replacement for the instrument's waitForComplete() that
+        acquires while waiting.  Returns the measured duration."""
+        for block in self.stream(estimate, timeout):
+            pass
+        return self.smu.lastWait[0]
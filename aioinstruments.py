@@ -0,0 +1,150 @@
+import asyncio
+import select
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from instruments import B2901A, MSO2102A
+
+
+"""asyncio interface to the instruments in instruments.py, so that one process
+can drive several instruments concurrently, e.g.:
+
+    smus = await asyncio.gather(AsyncB2901A.open("/dev/usbtmc0"),
+                                AsyncB2901A.open("/dev/usbtmc1"))
+    await asyncio.gather(*(smu.initiate() for smu in smus))
+    await asyncio.gather(*(smu.waitForComplete(10) for smu in smus))
+
+Each instrument's file I/O runs on its own single worker thread, which keeps
+operations on one device in order while different devices proceed in
+parallel; the USBTMC driver doesn't report read readiness reliably enough to
+do bulk reads from the event loop itself.  Waiting for completion is done on
+the event loop: the device fd is watched for SRQ (POLLPRI) through an epoll
+object registered with the loop.  Every operation takes an optional timeout
+(seconds), raising asyncio.TimeoutError.  A timed out read or write can't be
+interrupted and continues on the worker thread; give the instrument its own
+timeout (see Instrument.timeout) to bound it there too."""
+
+
+class AsyncInstrument:
+    """Wraps an instruments.Instrument with awaitable operations."""
+    instrumentClass = None
+
+    def __init__(self, instrument):
+        self.instrument = instrument
+        self._executor = ThreadPoolExecutor(max_workers=1)                          #serializes I/O on this device
+
+    @classmethod
+    async def open(cls, devicepath, timeout=None, **kwargs):
+        """Connects to the instrument at devicepath.  Construction identifies the
+        device, so it is done on the worker thread too."""
+        self = cls.__new__(cls)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.instrument = await self._run(partial(cls.instrumentClass, devicepath, **kwargs), timeout)
+        return self
+
+    async def _run(self, fn, timeout=None):
+        """Runs blocking callable fn on this instrument's worker thread."""
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn)
+        return await asyncio.wait_for(future, timeout)
+
+    async def call(self, method, *args, timeout=None, **kwargs):
+        """Runs any method of the wrapped instrument, by name, on the worker thread."""
+        return await self._run(partial(getattr(self.instrument, method), *args, **kwargs), timeout)
+
+    async def write(self, command, timeout=None):
+        await self._run(partial(self.instrument.write, command), timeout)
+
+    async def read(self, length=4000, timeout=None):
+        return await self._run(partial(self.instrument.read, length), timeout)
+
+    async def ask(self, command, length=4000, timeout=None):
+        return await self._run(partial(self.instrument.ask, command, length), timeout)
+
+    async def reset(self, timeout=None):
+        await self._run(self.instrument.reset, timeout)
+
+    async def clearStatus(self, timeout=None):
+        await self._run(self.instrument.clearStatus, timeout)
+
+    async def checkErrors(self, timeout=None):
+        await self._run(self.instrument.checkErrors, timeout)
+
+    async def done(self, timeout=None):
+        return await self._run(self.instrument.done, timeout)
+
+    async def waitForComplete(self, estimate=0, timeout=None):
+        """Awaitable equivalent of Instrument.waitForComplete(): waits until the
+        status byte shows completion of operations followed by *OPC.  Until the
+        estimated duration has passed, only an SRQ from the instrument wakes
+        the wait; after that, the status byte is polled with backoff.  Returns
+        the measured duration."""
+        instrument = self.instrument
+        start = time.perf_counter()
+        if instrument.mock:
+            await asyncio.sleep(estimate)
+            instrument.lastWait = (time.perf_counter() - start, estimate)
+            return instrument.lastWait[0]
+        loop = asyncio.get_running_loop()
+        srq = asyncio.Event()
+        watcher = select.epoll()                                                    #readable whenever the device signals SRQ
+        watcher.register(instrument.fd, select.EPOLLPRI)
+        loop.add_reader(watcher.fileno(), srq.set)
+        try:
+            interval = instrument.minPollInterval
+            while not await self.done():
+                now = time.perf_counter()
+                if timeout is not None and now - start > timeout:
+                    raise asyncio.TimeoutError("Operation did not complete within " + str(timeout) + " s")
+                remaining = start + estimate - now
+                sleep = remaining if remaining > interval else interval
+                if timeout is not None:
+                    sleep = min(sleep, start + timeout - now)                       #wake in time to time out
+                try:
+                    await asyncio.wait_for(srq.wait(), max(sleep, 0))               #sleep until estimate or SRQ
+                except asyncio.TimeoutError:
+                    pass
+                if remaining <= interval:
+                    interval = min(interval * 2, instrument.maxPollInterval)        #back off
+                srq.clear()
+        finally:
+            loop.remove_reader(watcher.fileno())
+            watcher.close()
+        instrument.lastWait = (time.perf_counter() - start, estimate)
+        return instrument.lastWait[0]
+
+    async def close(self):
+        await self._run(self.instrument.close)
+        self._executor.shutdown()
+
+
+class AsyncB2901A(AsyncInstrument):
+    """Awaitable interface to a Keysight B2901A SMU.  Methods not wrapped here
+    are available through call()."""
+    instrumentClass = B2901A
+
+    async def prepareVoltageListSweep(self, vlist, tstep, compliance=0.1, key=None, timeout=None):
+        await self._run(partial(self.instrument.prepareVoltageListSweep, vlist, tstep, compliance, key), timeout)
+
+    async def confirmVoltageList(self, timeout=None):
+        await self._run(self.instrument.confirmVoltageList, timeout)
+
+    async def initiate(self, monitor=True, wait=True, timeout=None):
+        await self._run(partial(self.instrument.initiate, monitor, wait), timeout)
+
+    async def enableOutput(self, en=True, timeout=None):
+        await self._run(partial(self.instrument.enableOutput, en), timeout)
+
+    async def measure(self, timeout=None):
+        return await self._run(self.instrument.measure, timeout)
+
+
+class AsyncMSO2102A(AsyncInstrument):
+    """Awaitable interface to a Rigol MSO2102A oscilloscope.  Methods not
+    wrapped here are available through call()."""
+    instrumentClass = MSO2102A
+
+    async def captureScreen(self, channel=1, timeout=None):
+        return await self._run(partial(self.instrument.captureScreen, channel), timeout)
+
+    async def captureMemory(self, channel=1, timeout=None):
+        return await self._run(partial(self.instrument.captureMemory, channel), timeout)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+#
+#Benchmarks for the PCM parse, compile and list upload paths, run against the
+#mock instrument.  Results are written as JSON for comparison between versions.
+#Each compiled file is also loaded back and checked against the parsed input.
+#REQUIRES Python 3.6 or later
+
+import sys, argparse
+import io
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from decimal import Decimal
+import pcm                          #pcm.py
+from instruments import B2901A      #instruments.py
+from tracing import Tracer          #tracing.py
+
+
+SCALES = {"small": 0, "medium": 1, "large": 2}
+
+
+def segmentsPCM(scale):
+    """One waveform of many segments on a 1 ms timebase, played once."""
+    n = [100, 1000, 10000][scale]
+    lines = ["DEF 1"]
+    for k in range(n):
+        lines.append(str(Decimal((k % 3) + 1) / 1000) + " " + str((k % 7) / 10))
+    lines.append("OUT ON")
+    lines.append("W 1 1")
+    lines.append("OUT OFF")
+    return lines
+
+
+def timebasePCM(scale):
+    """Many short waveforms whose segment durations share only a fine common
+    timestep, each played once."""
+    n = [10, 100, 1000][scale]
+    durations = [Decimal("0.003"), Decimal("0.0007"), Decimal("0.00011")]
+    lines = ["OUT ON"]
+    for k in range(1, n + 1):
+        lines.append("DEF " + str(k))
+        for d, duration in enumerate(durations):
+            lines.append(str(duration * (k % 5 + 1)) + " " + str(d * 0.5 + k % 3))
+        lines.append("W " + str(k) + " " + str(k % 4 + 1))
+    lines.append("OUT OFF")
+    return lines
+
+
+def replayPCM(scale):
+    """Two alternating waveforms under nested replays, the number of plays
+    doubling at each level."""
+    depth = [4, 8, 12][scale]
+    lines = ["DEF 1", "0.001 1", "0.002 0", "DEF 2", "0.001 0.5", "0.003 0", "OUT ON"]
+    for level in range(depth):
+        lines.extend(["W 1 1", "W 2 1", "R 1"])
+    lines.append("OUT OFF")
+    return lines
+
+
+def generatorPCM(scale):
+    """One waveform built by generator lines: a sine, a ramp and a PRBS
+    pattern, each of many samples."""
+    n = [10000, 100000, 1000000][scale]
+    lines = ["DEF 1",
+             "SINE 0.00001 " + str(Decimal(n) / 100000) + " 1 1000",
+             "RAMP 0.00001 " + str(Decimal(n) / 100000) + " 0 1",
+             "PRBS 0.00001 " + str(n) + " 0 1 15",
+             "OUT ON", "W 1 1", "OUT OFF"]
+    return lines
+
+
+def growingPCM(scale):
+    """One waveform played after each point added to it, so every play is of
+    a new copy and earlier copies can be freed while compiling."""
+    n = [20, 200, 2000][scale]
+    lines = ["DEF 1", "OUT ON"]
+    for k in range(n):
+        lines.extend(["0.001 " + str(k % 5), "W 1 1"])
+    lines.append("OUT OFF")
+    return lines
+
+
+SCENARIOS = {"segments": segmentsPCM, "timebase": timebasePCM, "replay": replayPCM, "generators": generatorPCM,
+             "growing": growingPCM}
+
+
+class CountingSMU:
+    """Mock B2901A, traced to count what would be sent, that doesn't wait for sweeps."""
+    def __init__(self, listFormat="ASCII"):
+        with redirect_stdout(io.StringIO()):
+            self.smu = B2901A("", mock=True)
+            if listFormat != "ASCII":
+                self.smu.setListDataFormat(listFormat)
+        self.tracer = Tracer()
+        self.smu.tracer = self.tracer
+        self.smu.waitForComplete = lambda estimate=0, timeout=None: 0.0
+
+    def totals(self):
+        """(messages, bytes, commands) sent so far."""
+        return (self.smu.transfersOut, self.smu.bytesOut, sum(stats.count for stats in self.tracer.commands.values()))
+
+
+def playAll(ops, counter):
+    """Plays ops on counter's SMU the way pcm.main() does.  Returns one
+    (points, iterations, seconds, messages, bytes, commands) tuple per play."""
+    plays = []
+
+    def play(wf, iterations):
+        before = counter.totals()
+        start = time.perf_counter()
+        pcm.playWaveform(wf, counter.smu, iterations)
+        elapsed = time.perf_counter() - start
+        plays.append((wf.length, iterations, elapsed) + tuple(b - a for a, b in zip(before, counter.totals())))
+
+    with redirect_stdout(io.StringIO()):
+        for op in pcm.expandReplays(ops):
+            if op[0] == 'W':
+                play(op[1], op[2])
+            elif op[0] == 'R':
+                for r in op[4]:
+                    play(r[1], r[2])
+    return plays
+
+
+def checkRoundTrip(ops, loaded):
+    """Raises ValueError unless loaded (operations from a compiled file) plays
+    the same waveforms as ops, comparing each W operation's length and hash."""
+    expected = [(op[1].length, op[1].contentHash()) for op in ops if op[0] == 'W']
+    found = [(op[1].length, op[1].contentHash()) for op in loaded if op[0] == 'W']
+    if len(found) != len(expected):
+        raise ValueError("compiled file has " + str(len(found)) + " plays, expected " + str(len(expected)))
+    for k, (a, b) in enumerate(zip(expected, found)):
+        if a != b:
+            raise ValueError("compiled play " + str(k) + " has " + str(b[0]) + " points (" + b[1][:8] +
+                             "), expected " + str(a[0]) + " (" + a[1][:8] + ")")
+
+
+def summarize(values):
+    if len(values) == 0:
+        return {"mean": 0, "max": 0}
+    return {"mean": sum(values) / len(values), "max": max(values)}
+
+
+def best(fn, repeat):
+    """Runs fn repeat times; returns (shortest time, last result)."""
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def benchmark(name, scale, args):
+    lines = SCENARIOS[name](SCALES[scale])
+    options = argparse.Namespace(max_error=args.max_error, max_rel_error=None)
+    parse = lambda: list(pcm.parsePCM(lines, 1, lambda wf: pcm.prepare(wf, options)))
+    with redirect_stdout(io.StringIO()):
+        parseTime, ops = best(parse, args.repeat)
+        tracemalloc.start()
+        parse()
+        parsePeak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        compileTime, compiled = best(lambda: compileBytes(pcm.parsePCM(lines, 1, lambda wf: pcm.prepare(wf, options))),
+                                     args.repeat)                                   #streamed, as pcm.py --compile does
+    with tempfile.NamedTemporaryFile(suffix=".pcmc") as f:
+        f.write(compiled)
+        f.flush()
+        loadTime, loaded = best(lambda: list(pcm.loadCompiledPCM(f.name, 1)), args.repeat)
+        checkRoundTrip(ops, loaded)
+        del loaded                                                                  #release views before unmapping
+    counter = CountingSMU(args.list_format)
+    plays = playAll(ops, counter)
+    return {"scenario": name, "scale": scale, "lines": len(lines),
+            "waveforms": sum(1 for op in ops if op[0] == 'DEF'),
+            "points": sum(op[1].length for op in ops if op[0] == 'W'),
+            "parse_s": parseTime, "parse_peak_bytes": parsePeak,
+            "compile_s": compileTime, "compiled_bytes": len(compiled), "load_s": loadTime,
+            "plays": len(plays), "play_host_s": sum(p[2] for p in plays),
+            "messages": sum(p[3] for p in plays), "upload_bytes": sum(p[4] for p in plays),
+            "commands": sum(p[5] for p in plays),
+            "per_play": {"upload_bytes": summarize([p[4] for p in plays]),
+                         "commands": summarize([p[5] for p in plays]),
+                         "messages": summarize([p[3] for p in plays]),
+                         "host_s": summarize([p[2] for p in plays])}}
+
+
+def compileBytes(ops):
+    out = io.BytesIO()
+    pcm.compilePCM(ops, out)
+    return out.getvalue()
+
+
+def main(args):
+    results = []
+    for scale in args.scales:
+        for name in args.scenarios:
+            result = benchmark(name, scale, args)
+            results.append(result)
+            print("%-10s %-6s parse %9.2f ms  compile %8.2f ms  peak %9d B  %6d plays  %10d B  %7d commands" %
+                  (name, scale, result["parse_s"] * 1000, result["compile_s"] * 1000, result["parse_peak_bytes"],
+                   result["plays"], result["upload_bytes"], result["commands"]), file=sys.stderr)
+    report = {"python": platform.python_version(), "list_format": args.list_format,
+              "max_error": args.max_error, "repeat": args.repeat, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = "Benchmarks PCM parsing, compiling and list uploads against \
+                       the mock instrument.  Writes results as JSON.")
+
+    parser.add_argument( "--scales",
+        help="Input sizes to run (default: all)",
+        nargs="+", choices=list(SCALES), default=list(SCALES))
+
+    parser.add_argument( "--scenarios",
+        help="Generated inputs to run (default: all)",
+        nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+
+    parser.add_argument( "--list-format",
+        help="Data format for voltage list uploads (default ASCII)",
+        choices=["ASCII", "REAL,32", "REAL,64"], default="ASCII")
+
+    parser.add_argument( "--max-error",
+        help="Timing error budget passed to waveform preparation, as pcm.py's \
+              --max-error",
+        metavar="SECONDS")
+
+    parser.add_argument( "--repeat",
+        help="Time each stage this many times and report the best (default 3)",
+        type=int, default=3, metavar="N")
+
+    parser.add_argument( "--output", "-o",
+        help="Write results to this file instead of standard output",
+        metavar="FILE")
+
+    main(parser.parse_args())
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import fcntl
+import select
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from instruments import ioc, InstrumentTimeout, B2901A, MSO2102A     #instruments.py
+
+
+"""Finds the instruments attached to this machine.  Every /dev/usbtmc* node
+is probed at once, each on its own thread with a short timeout, and
+identified by the vendor/product IDs and serial number the kernel reports in
+sysfs together with its *IDN? reply.  Replies are cached by the sysfs
+identity, so a device seen before (even on another node or after
+reconnecting) isn't queried again.  Devices without a USB serial number
+can't be told apart from another unit of the same model, so they are
+always queried:
+
+    found = discover()
+    for record in matching(found, cls=B2901A, serials=["MY12345678"]):
+        smu = connect(record)
+
+Each record is a dict with path, idn, model, serial (from the IDN), vid,
+pid, key (the sysfs identity, or None if it has none), cached, and error
+(None, or why the device couldn't be identified)."""
+
+CLASSES = [B2901A, MSO2102A]
+SYSFS = "/sys/class/usbmisc"
+CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                     "smu-control", "instruments.json")
+
+
+def devicePaths():
+    """Paths of all USB TMC device nodes present."""
+    return ["/dev/" + name for name in sorted(os.listdir("/dev/")) if "usbtmc" in name]
+
+
+def sysfsIdentity(devicepath):
+    """Returns (vid, pid, key) for a USB TMC device node from sysfs, where key
+    identifies the physical device by its IDs and USB serial number.  key is
+    None if the device has no serial number: its USB port would only say
+    where a unit is plugged in, not which one.  Returns None if the node
+    isn't in sysfs."""
+    name = os.path.basename(os.path.realpath(devicepath))
+    usb = os.path.dirname(os.path.realpath(os.path.join(SYSFS, name, "device")))   #interface's parent
+    try:
+        with open(os.path.join(usb, "idVendor")) as f:
+            vid = int(f.read(), 16)
+        with open(os.path.join(usb, "idProduct")) as f:
+            pid = int(f.read(), 16)
+    except (OSError, ValueError):
+        return None
+    try:
+        with open(os.path.join(usb, "serial")) as f:
+            serial = f.read().strip()
+    except OSError:
+        return vid, pid, None                                                       #not cacheable, see above
+    if not serial:
+        return vid, pid, None
+    return vid, pid, "%04x:%04x:%s" % (vid, pid, serial)
+
+
+def queryIdentity(devicepath, timeout=1.0):
+    """Opens devicepath, asks *IDN? and returns the reply, raising
+    InstrumentTimeout if it doesn't come within timeout seconds."""
+    fd = os.open(devicepath, os.O_RDWR | os.O_NOCTTY)
+    try:
+        try:
+            fcntl.ioctl(fd, ioc()._IOW(91, 10, 4), struct.pack("=I", max(int(timeout * 1000), 100)))
+            poller = None                                                           #the driver times out reads
+        except OSError:
+            poller = select.poll()
+            if os.path.basename(os.path.realpath(devicepath)).startswith("usbtmc"):
+                poller = None                                                       #older driver; its own timeout applies
+            else:
+                poller.register(fd, select.POLLIN)
+        os.write(fd, b"*IDN?\n")
+        deadline = time.perf_counter() + timeout
+        reply = b""
+        while not reply.endswith(b"\n"):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or (poller is not None and not poller.poll(remaining * 1000)):
+                raise InstrumentTimeout("No reply to *IDN? from " + devicepath)
+            try:
+                data = os.read(fd, 300)
+            except TimeoutError as e:
+                raise InstrumentTimeout("No reply to *IDN? from " + devicepath) from e
+            if not data:
+                break
+            reply = reply + data
+        return reply.decode().strip()
+    finally:
+        os.close(fd)
+
+
+def probe(devicepath, cache, timeout=1.0):
+    """Identifies one device node, using cache (a dict of key -> IDN) if it
+    knows the device.  Never raises; failures are reported in the record."""
+    record = {"path": devicepath, "idn": None, "model": None, "serial": None,
+              "vid": None, "pid": None, "key": None, "cached": False, "error": None}
+    identity = sysfsIdentity(devicepath)
+    if identity is not None:
+        record["vid"], record["pid"], record["key"] = identity
+    if record["key"] is not None and record["key"] in cache:
+        record["idn"] = cache[record["key"]]
+        record["cached"] = True
+    else:
+        try:
+            record["idn"] = queryIdentity(devicepath, timeout)
+        except (OSError, UnicodeDecodeError) as e:                                  #including timeouts
+            record["error"] = str(e)
+            return record
+        if not record["idn"]:
+            record["idn"] = None
+            record["error"] = "Empty reply to *IDN?"
+            return record
+    fields = record["idn"].split(",")
+    if len(fields) == 4:
+        record["model"], record["serial"] = fields[1].strip(), fields[2].strip()
+    return record
+
+
+def loadCache(path=CACHE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def saveCache(cache, path=CACHE):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)                                                 #never leave a partial file
+
+
+def discover(paths=None, timeout=1.0, useCache=True, cachePath=CACHE):
+    """Probes the device nodes in paths (default: every /dev/usbtmc*) in
+    parallel and returns a record for each, in the order given.  With
+    useCache, known devices aren't queried; identities learned are added to
+    the cache either way."""
+    if paths is None:
+        paths = devicePaths()
+    if len(paths) == 0:
+        return []
+    cache = loadCache(cachePath) if useCache else {}
+    with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+        records = list(pool.map(lambda path: probe(path, cache, timeout), paths))
+    learned = {r["key"]: r["idn"] for r in records if r["key"] is not None and r["idn"] is not None and not r["cached"]}
+    if learned:
+        cache = loadCache(cachePath)
+        cache.update(learned)
+        try:
+            saveCache(cache, cachePath)
+        except OSError:
+            pass                                                                    #cache is only an optimization
+    return records
+
+
+def classFor(record):
+    """The instrument class for a record: by USB IDs if known, else by the
+    model in its IDN.  None if neither matches."""
+    for cls in CLASSES:
+        if record["vid"] == cls.VID and record["pid"] == cls.PID:
+            return cls
+    for cls in CLASSES:
+        if record["model"] is not None and cls.expectedModel in record["model"]:
+            return cls
+    return None
+
+
+def matching(records, cls=None, serials=None):
+    """The identified records of class cls (any, if None), and if serials is
+    given, with one of those serial numbers, in the order of serials."""
+    found = [r for r in records if r["idn"] is not None and (cls is None or classFor(r) is cls)]
+    if serials is None:
+        return found
+    return [r for serial in serials for r in found if r["serial"] == serial]
+
+
+def connect(record, **kwargs):
+    """Creates the instrument object for a record without querying *IDN?
+    again.  Keyword arguments are passed to the class (e.g. timeout)."""
+    cls = classFor(record)
+    if cls is None:
+        raise ValueError("No instrument class for " + record["path"] + " (" + str(record["idn"]) + ")")
+    return cls(record["path"], idn=record["idn"], **kwargs)
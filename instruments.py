@@ -1,5 +1,13 @@
 import os
 import fcntl
+import errno
+import select
+import time
+import math
+import struct
+import hashlib
+from contextlib import contextmanager
+from itertools import repeat
 
 #These modules from https://github.com/olavmrk/python-ioctl
 #import ioctl
@@ -12,7 +20,6 @@ Use it however you like."""
 
 class ioc:
     """For translating C ioctl constants to Python."""
-    import struct
     def __init__(self):
         # constant for linux portability
         self._IOC_NRBITS = 8
@@ -50,6 +57,16 @@ class ioc:
         return self._IOC(self._IOC_READ | self._IOC_WRITE, type, nr, size)
 
 
+class InstrumentTimeout(TimeoutError):
+    """Raised when an instrument doesn't answer or finish in time."""
+    pass
+
+
+class InstrumentError(Exception):
+    """Raised when an instrument reports errors in its error queue."""
+    pass
+
+
 class Instrument:
     """Template class for generic USBTMC/USB488 instruments. Wraps USB-TMC
     (Test & Measurement Class) kernel driver. The kernel driver presents a file
@@ -57,37 +74,225 @@ class Instrument:
     to the system, i.e., should be a "/dev/usbtmc0" or similar present in /dev.
     Other specific instruments in this module inherit from this class.
     Instruments should speak SCPI / be IEEE 488.2 compliant."""
-    def __init__(self, devicepath, description="USB TMC instrument", mock=False):
-        """Argument 'device' (string) is path to /dev entry, typically /dev/usbtmc0 or /dev/usbtmc1"""
+    def __init__(self, devicepath, description="USB TMC instrument", mock=False, timeout=None, idn=None):
+        """Argument 'device' (string) is path to /dev entry, typically /dev/usbtmc0 or /dev/usbtmc1.
+        Argument 'timeout' (seconds) is the default deadline for each read, see
+        the timeout attribute.  Argument 'idn', if given, is the device's known
+        *IDN? reply (e.g. from discovery.py), and the query is skipped."""
         self.mock = mock
         self.devicepath = devicepath
-        if not self.mock:
-            self.fd = os.open(devicepath, os.O_RDWR)                                #open device file
+        self.timeout = timeout                                                      #default per-call read deadline, seconds, or None
+        self.autoRecover = True                                                     #recover() after every timed out transfer
+        self.maxTransferSize = 65536                                                #largest coalesced message, in bytes
+        self._batch = None                                                          #commands queued by batch(), or None
+        self._batchSize = 0
+        self.state = {}                                                             #shadow copy of settings programmed, see configure()
+        self.minPollInterval = 0.001                                                #status byte polling backoff, seconds
+        self.maxPollInterval = 0.05
+        self.lastWait = (0, 0)                                                      #(measured, estimated) duration of last waitForComplete()
+        self._poller = None
+        self.tracer = None                                                          #receives I/O events if set, see tracing.py
+        self.transfersOut = 0                                                       #I/O counters
+        self.transfersIn = 0
+        self.bytesOut = 0
+        self.bytesIn = 0
+        self.syscalls = 0
         self.ioc = ioc()                                                            #helper object for ioctl constant calculations
+        self._driverTimeout = None                                                  #USBTMC driver timeout now set, ms
+        self._readPoller = None                                                     #for fds that report read readiness
+        if not self.mock:
+            self.fd = os.open(devicepath, os.O_RDWR | os.O_NOCTTY)                  #open device file
+            self._driverTimeout = self.getDriverTimeout()
+            if self._driverTimeout is None and not os.path.basename(os.path.realpath(devicepath)).startswith("usbtmc"):
+                self._readPoller = select.poll()                                    #not the USBTMC driver: poll() for replies
+                self._readPoller.register(self.fd, select.POLLIN)
+        self._defaultDriverTimeout = self._driverTimeout
         print("Connecting to " + description + " at " + devicepath)
-        print("Requesting device to identify...")
         if self.mock:
+            print("Requesting device to identify...")
             self.idn = "mock,mock,mock,mock"
-        else:
+            print("Device replied: \"" + self.idn + "\"")
+        elif idn is None:
+            print("Requesting device to identify...")
             self.idn = self.identify()
-        print("Device replied: \"" + self.idn + "\"")
+            print("Device replied: \"" + self.idn + "\"")
+        else:
+            self.idn = idn
+            print("Device identified as \"" + self.idn + "\"")
         #extract manufacturer, model number, serial number, and revision number
         self.mfr, self.model, self.sn, self.version = self.idn.split(",")
         if self.expectedModel not in self.model:
             print("Warning: device returned model \'" + self.model + "\', expected \'" + self.expectedModel + "\'")
 
     #BASIC FILE I/O
-    def read(self, length=4000):
+    def read(self, length=4000, timeout=None):
         """Reads (text) from instrument.  Reads byte vector (file is binary),
         decodes into a string, strips leading/trailing whitespace and terminal newline"""
-        return self.readb().decode().strip()
-
-    def readb(self, length=4000):
-        """reads without any conversion, so returns a byte vector."""
+        return self.readb(length, timeout).decode().strip()
+
+    def readb(self, length=4000, timeout=None):
+        """reads without any conversion, so returns a byte vector.  Raises
+        InstrumentTimeout if nothing arrives within timeout seconds (default:
+        the timeout attribute; None waits as long as the driver does)."""
+        self.flush()                        #a reply can only follow the commands that were actually sent
+        began = time.perf_counter() if self.tracer is not None else 0
         if self.mock:
-            return "mock mock mock\n".encode()
+            data = "mock mock mock\n".encode()
         else:
+            deadline = self._deadline(timeout)
+            data = self._readChunk(length, deadline)
+            if self._readPoller is not None:
+                while data and not data.endswith(b"\n") and len(data) < length:      #not message-oriented: read to terminator
+                    data = data + self._readChunk(length - len(data), deadline)
+        self._received(len(data), began)
+        return data
+
+    def _received(self, length, began):
+        self.transfersIn = self.transfersIn + 1
+        self.bytesIn = self.bytesIn + length
+        if self.tracer is not None:
+            self.tracer.received(self, length, began, time.perf_counter())
+
+    def readBlock(self, into=None, timeout=None):
+        """Reads a response consisting of one IEEE 488.2 definite-length block
+        (#<n><length><data>, as returned for binary data formats) of any size.
+        The data is read straight into a preallocated bytearray, which is
+        returned without the header and terminator.  If into (a writable
+        buffer) is given, the data is read into it instead, and a memoryview
+        of the part filled is returned.  The whole block must arrive within
+        timeout seconds, as for readb()."""
+        self.flush()
+        began = time.perf_counter() if self.tracer is not None else 0
+        if self.mock:
+            self._received(0, began)
+            return bytearray() if into is None else memoryview(into)[:0]
+        deadline = self._deadline(timeout)
+        head = b""
+        while len(head) < 2:                                                        #header split across reads
+            head = head + self._readChunk(4096, deadline)
+        if head[:1] != b"#" or not head[1:2].isdigit() or head[1:2] == b"0":
+            raise ValueError("Expected a definite-length block, got " + repr(head[:20]))
+        start = 2 + int(head[1:2])
+        while len(head) < start:
+            head = head + self._readChunk(4096, deadline)
+        if not head[2:start].isdigit():
+            raise ValueError("Expected a definite-length block, got " + repr(head[:20]))
+        length = int(head[2:start])
+        if into is None:
+            data = bytearray(length)
+            view = memoryview(data)
+        else:
+            view = memoryview(into).cast("B")
+            if len(view) < length:
+                raise ValueError("Block of " + str(length) + " bytes does not fit buffer of " + str(len(view)))
+            view = view[:length]
+            data = view
+        got = min(len(head) - start, length)
+        view[:got] = head[start:start + got]
+        terminated = len(head) > start + length                                     #terminator already read
+        while got < length:
+            tail = bytearray(1)
+            self._ready(deadline)
+            self.syscalls = self.syscalls + 1
+            try:
+                n = os.readv(self.fd, [view[got:], tail])                           #read in place, plus terminator
+            except OSError as e:
+                self._failed(e)
+            if n == 0:
+                raise EOFError("Block ended after " + str(got) + " of " + str(length) + " bytes")
+            terminated = n > length - got
+            got = min(got + n, length)
+        if not terminated:
+            self._readChunk(1, deadline)                                            #consume terminating newline
+        self._received(start + length + 1, began)
+        return data
+
+    def _readChunk(self, length, deadline):
+        self._ready(deadline)
+        self.syscalls = self.syscalls + 1
+        try:
             return os.read(self.fd, length)
+        except OSError as e:
+            self._failed(e)
+
+    #TIMEOUTS
+    def _deadline(self, timeout):
+        """Returns the time.perf_counter() deadline for a call allowed timeout
+        seconds (None: the timeout attribute), or None for no deadline.  On the
+        USBTMC driver, also sets the driver timeout to match; _ready() lowers it
+        as the deadline approaches."""
+        if timeout is None:
+            timeout = self.timeout
+        if self._driverTimeout is not None:
+            if timeout is None:
+                ms = self._defaultDriverTimeout
+            else:
+                ms = max(int(math.ceil(timeout * 1000)), 100)                       #driver minimum is 100 ms
+            if ms != self._driverTimeout:
+                self.setDriverTimeout(ms)
+        if timeout is None:
+            return None
+        return time.perf_counter() + timeout
+
+    def _ready(self, deadline):
+        """Returns once a read may proceed without passing deadline.  Devices
+        other than the USBTMC driver are poll()ed for a reply, since the read
+        itself would block forever; the driver times out reads by itself, so
+        its timeout is cut to the time remaining (at least its 100 ms minimum),
+        which keeps a call of several transfers within its deadline."""
+        if deadline is None:
+            return
+        remaining = deadline - time.perf_counter()
+        if self._readPoller is None:
+            if remaining > 0:
+                if self._driverTimeout is not None:
+                    ms = max(int(math.ceil(remaining * 1000)), 100)
+                    if ms < self._driverTimeout:
+                        self.setDriverTimeout(ms)
+                return
+        else:
+            self.syscalls = self.syscalls + 1
+            if remaining > 0 and self._readPoller.poll(remaining * 1000):
+                return
+        self._failed(OSError(errno.ETIMEDOUT, "No reply from " + self.devicepath))
+
+    def _failed(self, error):
+        """Handles an OSError from a transfer: a timeout recovers (if autoRecover
+        is set) and raises InstrumentTimeout, anything else is re-raised."""
+        if error.errno != errno.ETIMEDOUT:
+            raise error
+        if self.autoRecover:
+            self.recover()
+        raise InstrumentTimeout("Timed out talking to " + self.devicepath) from error
+
+    def getDriverTimeout(self):
+        """Returns the USBTMC driver's transfer timeout in ms, or None if the
+        device doesn't support it (older kernels, or not a USBTMC device)."""
+        request = self.ioc._IOR(91, 9, 4)
+        try:
+            return struct.unpack("=I", self._ioctl("getDriverTimeout", request, bytes(4)))[0]
+        except OSError:
+            return None
+
+    def setDriverTimeout(self, ms):
+        """Sets the USBTMC driver's transfer timeout in ms (at least 100)."""
+        request = self.ioc._IOW(91, 10, 4)
+        self._ioctl("setDriverTimeout", request, struct.pack("=I", ms))
+        self._driverTimeout = ms
+
+    def recover(self):
+        """Brings communication back to a known state after a timed out
+        transfer: aborts any bulk transfers in progress, then issues a device
+        clear, which also discards queued commands and the shadow state.  On
+        devices other than the USBTMC driver, discards any pending input
+        instead."""
+        if self._readPoller is None:
+            for nr, name in ((4, "abortBulkIn"), (3, "abortBulkOut")):
+                try:
+                    self._ioctl(name, self.ioc._IO(91, nr))
+                except OSError:
+                    pass                    #nothing to abort
+        self.clear()
 
     def write(self, command):
         """Writes (text) to instrument. Adds a terminal newline and decodes to bytes,
@@ -96,16 +301,83 @@ class Instrument:
         self.writeb(cmd.encode())
 
     def writeb(self, command):
-        """writes without any conversion, so sends a byte vector.  Will fail if given a string."""
-        if self.mock:
+        """writes without any conversion, so sends a byte vector.  Will fail if given a string.
+        Inside a batch() the message is queued instead of sent."""
+        if self._batch is not None:
+            if command.endswith(b"\n"):
+                command = command[:-1]      #terminator is added back when the batch is sent
+            if self._batchSize + len(command) + 1 > self.maxTransferSize:
+                self.flush()                #would not fit, send what is queued first
+            self._batch.append(command)
+            self._batchSize = self._batchSize + len(command) + 1
             return
-        else:
-            os.write(self.fd, command)
+        self.transfersOut = self.transfersOut + 1
+        self.bytesOut = self.bytesOut + len(command)
+        began = time.perf_counter() if self.tracer is not None else 0
+        if not self.mock:
+            self.syscalls = self.syscalls + 1
+            try:
+                os.write(self.fd, command)
+            except OSError as e:
+                self._failed(e)
+        if self.tracer is not None:
+            self.tracer.sent(self, command, began, time.perf_counter())
+
+    @contextmanager
+    def batch(self):
+        """Context manager that coalesces commands into as few transfers as
+        possible.  Commands written inside the block are queued and sent as one
+        ';'-joined message when the block ends, when the queue would exceed
+        maxTransferSize bytes, or before anything is read from the
+        instrument.  Batches may be nested; the outermost one sends."""
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
+        self._batchSize = 0
+        try:
+            yield
+        finally:
+            self.flush()
+            self._batch = None
+
+    def flush(self):
+        """Send any commands queued by batch() as a single message."""
+        if not self._batch:
+            return
+        queued = self._batch
+        self._batch = None                  #send directly
+        try:
+            #each command is made absolute, so that it isn't parsed relative to the
+            #header path of the command preceding it in the compound message
+            self.writeb(b";".join(c if c[:1] in (b":", b"*") else b":" + c for c in queued) + b"\n")
+        finally:
+            self._batch = []
+            self._batchSize = 0
+
+    def configure(self, header, value):
+        """Programs a setting by sending '<header> <value>', unless the shadow
+        state shows that value is already in effect.  The shadow state is
+        discarded by reset() and clear(), or explicitly by invalidateState()."""
+        if self.state.get(header) == value:
+            return
+        self.write(header + " " + value)
+        self.state[header] = value
+
+    def invalidateState(self):
+        """Forget all settings recorded by configure(); the next configure()
+        of each setting will be sent."""
+        self.state.clear()
 
-    def ask(self, command, length=4000):
+    def ask(self, command, length=4000, timeout=None):
         """combined write-read for commands that end in '?', for convenience."""
         self.write(command)
-        return self.read(length)
+        return self.read(length, timeout)
+
+    def close(self):
+        """Closes the device file."""
+        if not self.mock:
+            os.close(self.fd)
 
     #IOCTL OPERATIONS
     #Commented lines below copied from tmc.h kernel header.
@@ -125,17 +397,43 @@ class Instrument:
     def pulse(self):
         """Request device to pulse an indicator on its front panel."""
         request = self.ioc._IO(91, 1)
-        fcntl.ioctl(self.fd, request)
+        self._ioctl("pulse", request)
 
     def clear(self):
-        """Issue a device-clear command."""
+        """Issue a device-clear command.  Discards any commands queued by batch()."""
+        if self._batch:
+            self._batch = []
+            self._batchSize = 0
+        self.invalidateState()
+        if self._readPoller is not None:
+            while self._readPoller.poll(0):                 #no USBTMC driver: just discard pending replies
+                if not os.read(self.fd, 4096):
+                    break
+            return
         request = self.ioc._IO(91, 2)
-        fcntl.ioctl(self.fd, request)
+        self._ioctl("clear", request)
 
     def readStatusByte(self):
-        """Read status byte over sidechannel.  Non-blocking."""
+        """Read status byte over sidechannel.  Non-blocking.  Returns an int.
+        Devices without the USBTMC driver (e.g. a simulator) are asked *STB?
+        instead."""
+        self.flush()
+        if self._readPoller is not None:
+            return int(self.ask("*STB?"))
         request = self.ioc._IOR(91, 18, 1)
-        return fcntl.ioctl(self.fd, request, 1)
+        return self._ioctl("readStatusByte", request, bytes(1))[0]  #driver fills in a one-byte buffer
+
+    def _ioctl(self, name, request, arg=None):
+        """Issues an ioctl on the device, counted and traced like transfers."""
+        began = time.perf_counter() if self.tracer is not None else 0
+        self.syscalls = self.syscalls + 1
+        try:
+            if arg is None:
+                return fcntl.ioctl(self.fd, request)
+            return fcntl.ioctl(self.fd, request, arg)
+        finally:
+            if self.tracer is not None:
+                self.tracer.control(self, name, began, time.perf_counter())
 
     #COMMON SCPI COMMANDS
     def identify(self):
@@ -143,22 +441,39 @@ class Instrument:
 
     def reset(self):
         self.write("*RST")
+        self.invalidateState()
 
     def clearStatus(self):
         self.write("*CLS")
 
+    def checkErrors(self):
+        """Reads the error queue (:SYST:ERR?) until it is empty.  If it held
+        any errors, the shadow state is discarded, since settings may not have
+        taken effect, and InstrumentError is raised listing them.  Call before
+        clearStatus(), which empties the queue."""
+        errors = []
+        while True:
+            reply = self.ask(":SYST:ERR?")
+            if self.mock or int(reply.split(",", 1)[0]) == 0:                       #mock has no error queue
+                break
+            errors.append(reply)
+        if errors:
+            self.invalidateState()
+            raise InstrumentError(self.devicepath + " reported: " + "; ".join(errors))
+
     def wait(self):
         """Issues a *WAI 'wait' command, which prohibits instrument from
         executing new commands until all pending commands have completed.  Does
         not block."""
         self.write("*WAI")
 
-    def shortWaitForComplete(self):
+    def shortWaitForComplete(self, timeout=None):
         """This is a BLOCKING wait for previous operations to complete.  It is
-        suitable for waiting on completion of reasonably short-duration (<2 sec)
-        operations.  Using this method to wait on longer operations WILL result
-        in a timeout error."""
-        self.ask("*OPC?")
+        suitable for waiting on completion of reasonably short-duration
+        operations.  Raises InstrumentTimeout if they take longer than timeout
+        seconds (default: the timeout attribute, or the driver's own timeout,
+        usually 5 s)."""
+        self.ask("*OPC?", timeout=timeout)
 
     def monitor(self):
         """This should be called immediately after any operation which will
@@ -170,17 +485,44 @@ class Instrument:
     def done(self):
         """This is a NON-BLOCKING query that returns True if the instrument has
         completed all previously assigned operations that were followed by a
-        call to monitor(), and False if it is still busy. This clears the ESR
-        register."""
-        print("Requesting status byte.")
-        n = int(self.readStatusByte())       #get status byte
-        print("Status byte is " + str(n))
-        opcbit = (n & 0x20) != 0     #check bit 5, event summary bit
-        print("OPC bit is: ", opcbit)
-        if opcbit == 1:                 #if operation is complete
-            return True
-        else:
-            return False
+        call to monitor(), and False if it is still busy.  Clear the status
+        registers (clearStatus()) before starting the next monitored operation."""
+        n = self.readStatusByte()           #get status byte
+        return (n & 0x20) != 0              #check bit 5, event summary bit
+
+    def waitForComplete(self, estimate=0, timeout=None):
+        """This is a BLOCKING wait for operations followed by monitor() (or any
+        other *OPC) to complete, suitable for operations of any length.  Returns
+        as soon as completion is seen, rather than after a fixed delay.  Until
+        the estimated duration (seconds) has passed, the wait sleeps in poll()
+        on the device, which the driver wakes when the instrument requests
+        service (the *SRE setup routes OPC there).  After that, and on drivers
+        without SRQ support, the status byte is polled with exponential backoff
+        from minPollInterval to maxPollInterval.  Raises InstrumentTimeout after
+        timeout seconds, if given.  Returns the measured duration; lastWait
+        holds (measured, estimated)."""
+        start = time.perf_counter()
+        if self.mock:
+            time.sleep(estimate)            #no status to poll; trust the estimate
+            self.lastWait = (time.perf_counter() - start, estimate)
+            return self.lastWait[0]
+        if self._poller is None:
+            self._poller = select.poll()
+            self._poller.register(self.fd, select.POLLPRI)                          #POLLPRI signals SRQ
+        interval = self.minPollInterval
+        while not self.done():
+            now = time.perf_counter()
+            if timeout is not None and now - start > timeout:
+                raise InstrumentTimeout("Operation did not complete within " + str(timeout) + " s")
+            remaining = start + estimate - now
+            sleep = remaining if remaining > interval else interval
+            if timeout is not None:
+                sleep = min(sleep, start + timeout - now)                           #wake in time to time out
+            self._poller.poll(max(sleep, 0) * 1000)                                 #sleep until estimate or SRQ
+            if remaining <= interval:
+                interval = min(interval * 2, self.maxPollInterval)                  #back off
+        self.lastWait = (time.perf_counter() - start, estimate)
+        return self.lastWait[0]
 
 
 
@@ -188,167 +530,433 @@ class B2901A(Instrument):
     """This class represents and controls a Keysight B2901A SMU.  For operating
     details of this instrument, refer to Keysight document B2910-90030, titled
     "Keysight B2900 SCPI Command Reference"."""
-
-    def __init__(self, device, mock=False):
-        self.description = "Keysight B2901 SMU"
-        self.expectedMfr = "Keysight Technologies"
-        self.expectedModel = "B2901A"
-        self.VID = 0x0957
-        self.PID = 0x8b18
+    description = "Keysight B2901 SMU"
+    expectedMfr = "Keysight Technologies"
+    expectedModel = "B2901A"
+    VID = 0x0957
+    PID = 0x8b18
+
+    def __init__(self, device, mock=False, timeout=None, idn=None):
+        self.maxListLength = 2500   #maximum number of points in a list sweep
+        self.maxSweepPoints = 100000    #maximum trigger count x arm count
+        self.maxTracePoints = 100000    #trace buffer size
+        self.minTriggerInterval = 0.00002   #shortest timer trigger interval, seconds
+        self.listFormat = "ASCII"   #data format for list uploads, see setListDataFormat()
+        self._uploadedList = None   #key of list sent but not yet confirmed, see confirmVoltageList()
         #call superclass constructor, which connects and gathers some info
-        super().__init__(device, description=self.description, mock=mock)
+        super().__init__(device, description=self.description, mock=mock, timeout=timeout, idn=idn)
         #instrument-specific additional setup
-        self.write("*ESE 1")    #enable summary of bit 0, Event Status register, to enable *OPC monitoring
-        self.write("*SRE 32")   #enable summary of bit 5, Status Byte, to enable *OPC monitoring
+        with self.batch():
+            self.write("*ESE 1")    #enable summary of bit 0, Event Status register, to enable *OPC monitoring
+            self.write("*SRE 32")   #enable summary of bit 5, Status Byte, to enable *OPC monitoring
+
+
+    def reset(self):
+        super().reset()
+        self.listFormat = "ASCII"   #*RST restores ASCII data format
 
+    def invalidateState(self):
+        super().invalidateState()
+        self._uploadedList = None   #may or may not have been loaded
 
     #SOURCE control methods
     def setSourceFunctionToVoltage(self):
-        self.write(":FUNC:MODE VOLT")
+        self.configure(":FUNC:MODE", "VOLT")
 
     def setSourceFunctionToCurrent(self):
-        self.write(":FUNC:MODE CURR")
+        self.configure(":FUNC:MODE", "CURR")
 
     def setVoltage(self,v):
         """Takes float argument."""
-        self.write(":VOLT " + str(v))
+        self.configure(":VOLT", str(v))
 
     def setCurrent(self,a):
         """Takes float argument."""
-        self.write(":CURR " + str(a))
+        self.configure(":CURR", str(a))
 
     def setOutputShapeToDC(self):
-        self.write(":FUNC DC")
+        self.configure(":FUNC", "DC")
 
     def setOutputShapeToPulse(self):
-        self.write(":FUNC PULS")
+        self.configure(":FUNC", "PULS")
 
     def setVoltageModeToList(self):
-        self.write(":SOURCE:VOLT:MODE LIST")
+        self.configure(":SOURCE:VOLT:MODE", "LIST")
 
     def setVoltageModeToFixed(self):
-        self.write(":SOURCE:VOLT:MODE FIX")
-
-    def setVoltageList(self, vsl):
-        """vsl is list of voltages for sweep.  May be text, Decimal, or float."""
-        fvsl = [float(v) for v in vsl]      #convert to float
-        s = ""
-        for f in fvsl[:-1]:         #all but last item
-            s = s +str(f) + ","
-        s = s + str(fvsl[-1])      #add last item without a comma
-        self.write(":LIST:VOLT " + s)  #don't send the last character, a comma
+        self.configure(":SOURCE:VOLT:MODE", "FIX")
+
+    def setVoltageList(self, vsl, key=None):
+        """vsl is list of voltages for sweep.  May be text, Decimal, or float.
+        key identifies the list content (e.g. a hash); if a list with the same
+        key is already loaded, nothing is sent.  Without a key, the encoded
+        message's hash is used."""
+        message = None
+        if key is None:
+            message = self.encodeVoltageList(vsl)
+            key = hashlib.sha1(message).hexdigest()
+        if self.state.get(":LIST:VOLT") == key:
+            return                          #already loaded
+        if message is None:
+            message = self.encodeVoltageList(vsl)
+        self.loadVoltageList(message, key)
+
+    def loadVoltageList(self, message, key=None):
+        """Sends a list message prepared by encodeVoltageList().  key (or the
+        message's hash) is only recorded as the loaded list, so that it isn't
+        sent again, once confirmVoltageList() finds the upload was accepted."""
+        if self.listFormat != "ASCII":
+            self.setDataFormat(self.listFormat)     #instrument may have been switched for a fetch
+        self.state.pop(":LIST:VOLT", None)
+        self.writeb(message)
+        self._uploadedList = key if key is not None else hashlib.sha1(message).hexdigest()
+
+    def confirmVoltageList(self):
+        """Checks the error queue if a list was sent since the last check (see
+        checkErrors()), and if there were no errors records it as loaded.
+        Raises InstrumentError if the upload or any other command failed."""
+        if self._uploadedList is None:
+            return
+        key = self._uploadedList
+        self._uploadedList = None
+        self.checkErrors()
+        self.state[":LIST:VOLT"] = key
+
+    def encodeVoltageList(self, vsl):
+        """Returns the complete message (bytes) that loads voltage list vsl,
+        without sending it.  Lets callers prepare a list ahead of time, e.g. on
+        another thread.  Uses the format chosen with setListDataFormat(): a
+        comma-separated ASCII list, or an IEEE 488.2 definite-length block
+        (#<n><length><data>) of big-endian floats packed into one buffer.
+        If vsl has a runs() method yielding (count, voltage) pairs, as a
+        run-length encoded waveform does, each run is encoded as a whole
+        rather than point by point."""
+        header = b":LIST:VOLT "
+        runs = vsl.runs() if hasattr(vsl, "runs") else None
+        if self.listFormat == "ASCII":
+            if runs is None:
+                return header + ",".join([str(float(v)) for v in vsl]).encode() + b"\n"
+            return header + ",".join([",".join(repeat(str(float(v)), n)) for n, v in runs if n > 0]).encode() + b"\n"
+        code, size = ("d", 8) if self.listFormat == "REAL,64" else ("f", 4)
+        count = len(vsl)
+        length = str(count * size).encode()
+        prefix = header + b"#" + str(len(length)).encode() + length
+        buf = bytearray(len(prefix) + count * size + 1)    #preallocate entire message
+        buf[:len(prefix)] = prefix
+        if runs is None:
+            struct.pack_into(">" + str(count) + code, buf, len(prefix), *map(float, vsl))
+        else:
+            offset = len(prefix)
+            for n, v in runs:
+                buf[offset:offset + n * size] = struct.pack(">" + code, v) * n
+                offset = offset + n * size
+        buf[-1] = ord("\n")
+        return bytes(buf)
+
+    def setListDataFormat(self, fmt="ASCII"):
+        """Selects the data format used for list uploads: "ASCII", "REAL,32" or
+        "REAL,64".  Binary formats are sent big-endian."""
+        self.setDataFormat(fmt)
+        self.listFormat = fmt
+
+    def setDataFormat(self, fmt="ASCII"):
+        """Sets the instrument's data format, "ASCII", "REAL,32" or "REAL,64",
+        big-endian for the binary formats.  This applies to query responses
+        too, so methods that read data select the format they expect."""
+        self.configure(":FORM:DATA", fmt)
+        if fmt != "ASCII":
+            self.configure(":FORM:BORD", "NORM")
 
     def enableContinuousTrigger(self, en=True):
         if en:
-            self.write(":FUNC:TRIG:CONT ON")
+            self.configure(":FUNC:TRIG:CONT", "ON")
         else:
-            self.write(":FUNC:TRIG:CONT OFF")
+            self.configure(":FUNC:TRIG:CONT", "OFF")
 
     def enableSourceVoltAutorange(self, en=True):
         if en:
-            self.write(":SOUR:VOLT:RANG:AUTO ON")
+            self.configure(":SOUR:VOLT:RANG:AUTO", "ON")
         else:
-            self.write(":SOUR:VOLT:RANG:AUTO OFF")
+            self.configure(":SOUR:VOLT:RANG:AUTO", "OFF")
 
     #SENSE control methods
     #--------------------------
     def setSenseFunctionToCurrent(self):
-        self.write(":SENS:FUNC CURR")
+        self.configure(":SENS:FUNC", "CURR")
 
     def setSenseFunctionToVoltage(self):
-        self.write(":SENS:FUNC VOLT")
+        self.configure(":SENS:FUNC", "VOLT")
 
     def setCurrentComplianceLevel(self,a):
-        self.write(":SENS:CURR:PROT " + str(a))
+        self.configure(":SENS:CURR:PROT", str(a))
 
     def setVoltageProtectionLevel(self,v):
-        self.write(":SENS:VOLT:PROT " + str(v))
+        self.configure(":SENS:VOLT:PROT", str(v))
 
     def enableRemoteSensing(self, en=True):
         if en:
-            self.write(":SENS:REM ON")
+            self.configure(":SENS:REM", "ON")
         else:
-            self.write(":SENS:REM OFF")
+            self.configure(":SENS:REM", "OFF")
 
     def enableSenseCurrentAutorange(self, en=True):
         if en:
-            self.write(":SENS:CURR:RANG:AUTO ON")
+            self.configure(":SENS:CURR:RANG:AUTO", "ON")
         else:
-            self.write(":SENS:CURR:RANG:AUTO OFF")
+            self.configure(":SENS:CURR:RANG:AUTO", "OFF")
 
     #TRIGGER control
     #-------------------------
     def setTriggerAcquisitionDelay(self, delay):
         """set delay between trigger and acquisition"""
-        self.write(":TRIG:ACQ:DEL " + str(delay))
+        self.configure(":TRIG:ACQ:DEL", str(delay))
 
     def setTriggerTransientDelay(self, delay):
         """set delay between trigger and transient (output change)"""
-        self.write(":TRIG:TRAN:DEL " + str(delay))
+        self.configure(":TRIG:TRAN:DEL", str(delay))
 
     def setArmCount(self, count):
-        self.write(":ARM:COUNT " + str(count))
+        self.configure(":ARM:COUNT", str(count))
 
     def setArmImmediate(self):
         self.write(":ARM:IMM")
 
     def setArmDelay(self, delay):
-        self.write(":ARM:DELAY " + str(delay))
+        self.configure(":ARM:DELAY", str(delay))
 
     def setTriggerSourceToTimer(self):
-        self.write("TRIG:SOURCE TIMER")
+        self.configure("TRIG:SOURCE", "TIMER")
 
     def setTriggerCount(self, count):
-        self.write("TRIG:COUNT " + str(count))
+        self.configure("TRIG:COUNT", str(count))
 
     def setTriggerTimerInterval(self, interval):
-        self.write("TRIG:TIMER " + str(interval))
+        self.configure("TRIG:TIMER", str(interval))
 
     #Other
     #------------------------
     def enableOutput(self, en=True):
         if en:
-            self.write(":OUTP ON")
+            self.configure(":OUTP", "ON")
         else:
-            self.write(":OUTP OFF")
+            self.configure(":OUTP", "OFF")
 
     def measure(self):
         """Perform a spot measurement using current parameters, returns a float."""
+        with self.batch():
+            self.setDataFormat("ASCII")
+            self.configure(":FORM:ELEM:SENS", self.state.get(":SENS:FUNC", "CURR"))    #just the sensed quantity
         return float(self.ask(":MEAS?"))
 
-    def initiate(self):
-        """Initiates a source/measure operation already set up"""
-        self.write(":INIT;*WAI;*OPC")
+    def fetchArrays(self, elements=("VOLT", "CURR", "TIME", "STAT")):
+        """Fetches all measurement data of the last sweep in one binary (REAL,64)
+        transfer.  elements lists the data to return, from VOLT, CURR, RES,
+        TIME, STAT and SOUR.  Returns a dict of NumPy arrays keyed by element;
+        these are views into the received buffer, except STAT, which is
+        converted to uint32.  Requires NumPy."""
+        import numpy                        #optional dependency, only needed here
+        data = self.queryArray(":FETC:ARR?", elements)
+        arrays = {}
+        for k, name in enumerate(elements):
+            arrays[name] = data[:, k]
+            if name == "STAT":
+                arrays[name] = data[:, k].astype(numpy.uint32)
+        return arrays
+
+    def queryArray(self, query, elements):
+        """Sends a data query with the given sense elements selected, and returns
+        the REAL,64 response as a NumPy array with one row per point and one
+        column per element, viewing the received buffer.  Requires NumPy."""
+        import numpy                        #optional dependency, only needed here
+        with self.batch():
+            self.setDataFormat("REAL,64")
+            self.configure(":FORM:ELEM:SENS", ",".join(elements))
+            self.write(query)
+        return numpy.frombuffer(self.readBlock(), dtype=">f8").reshape(-1, len(elements))
+
+    #TRACE buffer
+    #------------------------
+    def enableTraceBuffer(self, points=100000):
+        """Clears the trace buffer and starts storing sense data in it, up to
+        points entries.  Storing stops when the buffer is full."""
+        with self.batch():
+            self.write(":TRAC:FEED:CONT NEV")
+            self.write(":TRAC:CLE")
+            self.configure(":TRAC:FEED", "SENS")
+            self.configure(":TRAC:POIN", str(points))
+            self.write(":TRAC:FEED:CONT NEXT")
+
+    def tracePoints(self):
+        """Returns the number of entries stored in the trace buffer."""
+        return int(self.ask(":TRAC:POIN:ACT?"))
+
+    def readTrace(self, offset, size, elements=("VOLT", "CURR", "TIME", "STAT")):
+        """Returns size trace buffer entries starting at offset, as a NumPy
+        array with one column per element (see queryArray())."""
+        return self.queryArray(":TRAC:DATA? " + str(offset) + "," + str(size), elements)
+
+    def initiate(self, monitor=True, wait=True):
+        """Initiates a source/measure operation already set up.  With monitor
+        True, completion sets OPC for waitForComplete()/done(); when queuing
+        several sweeps, monitor only the last so the wait covers all of them.
+        With wait True, *WAI makes the instrument hold every later command and
+        query until the sweep ends; use wait=False to query the instrument
+        (e.g. read the trace buffer) while it sweeps, and detect the end from
+        the status byte only."""
+        command = ":INIT"
+        if wait:
+            command = command + ";*WAI"
+        if monitor:
+            command = command + ";*OPC"
+        self.write(command)
 
     #Combination functions which make life easier
     #--------------------------
-    def prepareVoltageListSweep(self, vlist, tstep, compliance=0.1):
+    def prepareVoltageListSweep(self, vlist, tstep, compliance=0.1, key=None):
         """Prepares a list sweep, outputting voltage and measuring current.
-        vlist is a list of voltages. tstep is the time step (seconds).
-        compliance is current compliance limit (amps). Sweep can be executed
-        by calling initiate() afterward."""
+        vlist is a list of voltages (any sized iterable). tstep is the time step
+        (seconds). compliance is current compliance limit (amps). key optionally
+        identifies the list content, see setVoltageList(). Sweep can be executed
+        by calling initiate() afterward.  The settings are sent as a single
+        batch; settings already in effect are not resent."""
         points = len(vlist)
-        self.setSourceFunctionToVoltage()        #output voltage
-        self.enableSourceVoltAutorange(True)        #enable voltage autoranging
-        self.setVoltageModeToList()                #using list sweep mode
-        self.setVoltageList(vlist)                #load requested sweep list
-        self.setSenseFunctionToCurrent()            #sensing current
-        self.enableSenseCurrentAutorange(True)    #enable current autoranging
-        self.setCurrentComplianceLevel(compliance)        #set current compliance
-        self.setTriggerSourceToTimer()            #use timer as trigger source
-        self.setTriggerTimerInterval(tstep)        #program the timer step
-        self.setTriggerCount(points)            #number of data points to collect
-        self.setTriggerAcquisitionDelay(tstep/10)
+        with self.batch():                           #send whole setup as one message
+            self.setSourceFunctionToVoltage()        #output voltage
+            self.enableSourceVoltAutorange(True)        #enable voltage autoranging
+            self.setVoltageModeToList()                #using list sweep mode
+            self.setVoltageList(vlist, key)                #load requested sweep list
+            self.setSenseFunctionToCurrent()            #sensing current
+            self.enableSenseCurrentAutorange(True)    #enable current autoranging
+            self.setCurrentComplianceLevel(compliance)        #set current compliance
+            self.setTriggerSourceToTimer()            #use timer as trigger source
+            self.setTriggerTimerInterval(tstep)        #program the timer step
+            self.setTriggerCount(points)            #number of data points to collect
+            self.setTriggerAcquisitionDelay(tstep/10)
+
+    def performVoltageListSweep(self, vlist, tstep, compliance=0.1):
+        """Prepares and runs a list sweep (see prepareVoltageListSweep()), waits
+        for it to finish, and returns [voltages, currents] measured at each
+        point as NumPy arrays.  Raises ValueError if vlist is longer than
+        maxListLength, and InstrumentError if the instrument rejects the setup."""
+        if len(vlist) > self.maxListLength:
+            raise ValueError("List of " + str(len(vlist)) + " points exceeds the instrument's maximum of " +
+                             str(self.maxListLength))
+        with self.batch():
+            self.prepareVoltageListSweep(vlist, tstep, compliance)
+            self.setArmCount(1)
+        if self._uploadedList is not None:
+            self.confirmVoltageList()
+        else:
+            self.checkErrors()              #list already loaded; check the settings
+        with self.batch():
+            self.clearStatus()
+            self.initiate()
+        self.waitForComplete(float(len(vlist) * tstep))
+        data = self.fetchArrays(("VOLT", "CURR"))
+        return [data["VOLT"], data["CURR"]]
 
 
 
 
 class MSO2102A(Instrument):
-    def __init__(self, device):
-        self.description = "Rigol MSO2102A Oscilloscope"
-        self.expectedMfr = "RIGOL TECHNOLOGIES"
-        self.expectedModel = "MSO2102A"
-        self.VID = 0x1ab1
-        self.PID = 0x04b0
+    """This class represents and controls a Rigol MSO2102A oscilloscope.  For
+    operating details, refer to the Rigol "MSO2000A/DS2000A Programming
+    Guide"."""
+    description = "Rigol MSO2102A Oscilloscope"
+    expectedMfr = "RIGOL TECHNOLOGIES"
+    expectedModel = "MSO2102A"
+    VID = 0x1ab1
+    PID = 0x04b0
+
+    def __init__(self, device, mock=False, timeout=None, idn=None):
+        self.maxBytePoints = 250000     #most points per :WAV:DATA? read in BYTE format
         #call superclass constructor, which connects and gathers some info
-        super().__init__(device, self.description)
+        super().__init__(device, description=self.description, mock=mock, timeout=timeout, idn=idn)
+
+    def run(self):
+        self.write(":RUN")
+
+    def stop(self):
+        self.write(":STOP")
+
+    def single(self):
+        self.write(":SING")
+
+    #WAVEFORM readout
+    #--------------------------
+    def setWaveformSource(self, channel=1):
+        self.configure(":WAV:SOUR", "CHAN" + str(channel))
+
+    def setWaveformMode(self, mode="NORM"):
+        """NORM reads the points on screen; RAW reads acquisition memory (the
+        scope must be stopped); MAX reads memory when stopped, else screen."""
+        self.configure(":WAV:MODE", mode)
+
+    def setWaveformFormatToByte(self):
+        self.configure(":WAV:FORM", "BYTE")
+
+    def preamble(self):
+        """Returns the waveform preamble (:WAV:PRE?) as a dict of format, type,
+        points, count, xincrement, xorigin, xreference, yincrement, yorigin,
+        yreference."""
+        if self.mock:
+            values = ["0", "0", "0", "1", "1", "0", "0", "1", "0", "0"]
+        else:
+            values = self.ask(":WAV:PRE?").split(",")
+        names = ["format", "type", "points", "count", "xincrement", "xorigin", "xreference",
+                 "yincrement", "yorigin", "yreference"]
+        pre = dict(zip(names, [float(v) for v in values]))
+        for name in names[:4]:
+            pre[name] = int(pre[name])
+        return pre
+
+    def captureScreen(self, channel=1):
+        """Reads the waveform displayed for channel.  Returns (time, voltage) as
+        NumPy arrays.  Requires NumPy."""
+        with self.batch():
+            self.setWaveformSource(channel)
+            self.setWaveformMode("NORM")
+            self.setWaveformFormatToByte()
+        pre = self.preamble()
+        raw = self.readWaveformData(1, pre["points"])
+        return self.scale(raw, pre)
+
+    def captureMemory(self, channel=1):
+        """Stops the scope and reads the whole acquisition memory for channel,
+        in chunks of maxBytePoints.  Each chunk is read straight into one
+        preallocated array.  Returns (time, voltage) as NumPy arrays.
+        Requires NumPy."""
+        with self.batch():
+            self.stop()
+            self.setWaveformSource(channel)
+            self.setWaveformMode("RAW")
+            self.setWaveformFormatToByte()
+        pre = self.preamble()
+        raw = self.readWaveformData(1, pre["points"])
+        return self.scale(raw, pre)
+
+    def readWaveformData(self, first, count):
+        """Reads count raw (BYTE) points starting at point first (1-based), in as
+        many :WAV:DATA? reads as needed, into a single NumPy uint8 array."""
+        import numpy                        #optional dependency, only needed here
+        raw = numpy.empty(count, numpy.uint8)
+        got = 0
+        while got < count:
+            n = min(self.maxBytePoints, count - got)
+            with self.batch():
+                self.write(":WAV:STAR " + str(first + got))
+                self.write(":WAV:STOP " + str(first + got + n - 1))
+                self.write(":WAV:DATA?")
+            filled = len(self.readBlock(raw[got:]))
+            if filled == 0:
+                break                       #nothing more available
+            got = got + filled
+        return raw[:got]
+
+    def scale(self, raw, pre):
+        """Converts raw BYTE waveform data to (time, voltage) NumPy arrays using
+        preamble pre, without per-point Python work."""
+        import numpy                        #optional dependency, only needed here
+        volts = (raw - (pre["yorigin"] + pre["yreference"])) * pre["yincrement"]
+        times = (numpy.arange(len(raw)) - pre["xreference"]) * pre["xincrement"] + pre["xorigin"]
+        return times, volts
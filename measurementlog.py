@@ -0,0 +1,173 @@
+import bisect
+import json
+import mmap
+import struct
+import numpy
+
+
+"""Compact columnar file format for measurement data, written incrementally
+during acquisition and read back through a memory map.
+
+    header   magic "SMULOG01", u32 rows per chunk, u32 column count, then per
+             column a 16-byte name and 8-byte NumPy dtype string, then u32
+             length and JSON metadata (e.g. instrument IDN and settings)
+    chunks   u64 row count, then each column's values for those rows,
+             contiguous and padded to a multiple of 8 bytes
+    trailer  written on close: JSON metadata added while writing (e.g. the
+             waveform played in each sweep), then u64 trailer offset and
+             magic "SMULOGTR"
+
+All integers are little-endian.  Full chunks hold the configured number of
+rows; flush() and close() may write shorter ones.  A file whose writer did
+not close it lacks the trailer but its chunks remain readable."""
+
+MAGIC = b"SMULOG01"
+TRAILER_MAGIC = b"SMULOGTR"
+COLUMN = struct.Struct("<16s8s")
+FOOTER = struct.Struct("<Q8s")
+
+
+def padded(n):
+    """n rounded up to a multiple of 8."""
+    return (n + 7) & ~7
+
+
+class MeasurementLog:
+    """Writes a measurement log.  columns is a list of (name, dtype) pairs.
+    Appended rows are collected in preallocated column buffers and written
+    a whole chunk at a time, so memory use stays fixed however long the
+    capture runs.  Sweeps are numbered with startSweep(); a column named
+    SWEEP, if present and not supplied to append(), is filled with the
+    current sweep number."""
+    def __init__(self, path, columns, metadata=None, chunkRows=65536):
+        self.file = open(path, "wb")
+        self.columns = [(name, numpy.dtype(dtype).newbyteorder("<")) for name, dtype in columns]
+        self.chunkRows = chunkRows
+        self.buffers = {name: numpy.empty(chunkRows, dtype) for name, dtype in self.columns}
+        self.fill = 0                                   #rows buffered
+        self.rows = 0                                   #rows appended in total
+        self.sweep = -1
+        self.trailer = {"sweeps": []}                   #metadata collected while writing
+        meta = json.dumps(metadata or {}).encode()
+        header = MAGIC + struct.pack("<II", chunkRows, len(self.columns))
+        header = header + b"".join(COLUMN.pack(name.encode(), dtype.str.encode()) for name, dtype in self.columns)
+        header = header + struct.pack("<I", len(meta)) + meta
+        self.file.write(header + bytes(padded(len(header)) - len(header)))
+
+    def startSweep(self, label=None):
+        """Starts a new sweep; label (e.g. the waveform's content hash) is
+        recorded in the trailer metadata under "sweeps"."""
+        self.sweep = self.sweep + 1
+        self.trailer["sweeps"].append(label)
+
+    def append(self, data):
+        """Appends rows.  data maps column names to equal-length arrays."""
+        count = len(next(iter(data.values())))
+        done = 0
+        while done < count:
+            n = min(count - done, self.chunkRows - self.fill)
+            for name, dtype in self.columns:
+                if name in data:
+                    self.buffers[name][self.fill:self.fill + n] = data[name][done:done + n]
+                elif name == "SWEEP":
+                    self.buffers[name][self.fill:self.fill + n] = self.sweep
+                else:
+                    self.buffers[name][self.fill:self.fill + n] = 0
+            self.fill = self.fill + n
+            done = done + n
+            if self.fill == self.chunkRows:
+                self.flush()
+        self.rows = self.rows + count
+
+    def flush(self):
+        """Writes buffered rows as a chunk."""
+        if self.fill == 0:
+            return
+        self.file.write(struct.pack("<Q", self.fill))
+        for name, dtype in self.columns:
+            size = self.fill * dtype.itemsize
+            self.file.write(memoryview(self.buffers[name][:self.fill]).cast("B"))
+            self.file.write(bytes(padded(size) - size))
+        self.fill = 0
+        self.file.flush()
+
+    def close(self):
+        """Writes remaining rows and the trailer, and closes the file."""
+        self.flush()
+        offset = self.file.tell()
+        self.trailer["rows"] = self.rows
+        self.file.write(json.dumps(self.trailer).encode())
+        self.file.write(FOOTER.pack(offset, TRAILER_MAGIC))
+        self.file.close()
+
+
+class MeasurementLogReader:
+    """Reads a measurement log through a memory map.  Data is only touched
+    when read, so any part of a long capture can be sliced out without
+    loading the rest.  metadata holds the header metadata merged with the
+    trailer's, if present."""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(path + " is not a measurement log")
+        self.chunkRows, ncols = struct.unpack_from("<II", self.map, len(MAGIC))
+        pos = len(MAGIC) + 8
+        self.columns = []
+        for k in range(ncols):
+            name, dtype = COLUMN.unpack_from(self.map, pos)
+            self.columns.append((name.rstrip(b"\0").decode(), numpy.dtype(dtype.rstrip(b"\0").decode())))
+            pos = pos + COLUMN.size
+        (length,) = struct.unpack_from("<I", self.map, pos)
+        self.metadata = json.loads(self.map[pos + 4:pos + 4 + length].decode())
+        pos = padded(pos + 4 + length)
+        end = len(self.map)
+        if end >= FOOTER.size:
+            offset, magic = FOOTER.unpack_from(self.map, end - FOOTER.size)
+            if magic == TRAILER_MAGIC:
+                self.metadata.update(json.loads(self.map[offset:end - FOOTER.size].decode()))
+                end = offset
+        self.chunks = []                                #(first row, row count, offset of row count)
+        self.rows = 0
+        while pos + 8 <= end:
+            (rows,) = struct.unpack_from("<Q", self.map, pos)
+            size = 8 + sum(padded(rows * dtype.itemsize) for name, dtype in self.columns)
+            if rows == 0 or pos + size > end:
+                break                                   #incomplete chunk from an interrupted writer
+            self.chunks.append((self.rows, rows, pos))
+            self.rows = self.rows + rows
+            pos = pos + size
+        self.firsts = [first for first, rows, pos in self.chunks]
+
+    def __len__(self):
+        return self.rows
+
+    def chunkColumn(self, k, name):
+        """Returns column name of chunk k, as an array viewing the map."""
+        first, rows, pos = self.chunks[k]
+        pos = pos + 8
+        for col, dtype in self.columns:
+            if col == name:
+                return numpy.frombuffer(self.map, dtype, rows, pos)
+            pos = pos + padded(rows * dtype.itemsize)
+        raise KeyError(name)
+
+    def read(self, name, start=0, stop=None):
+        """Returns rows start to stop of column name.  A range within one chunk
+        is a view of the map; otherwise the chunks' pieces are concatenated."""
+        if stop is None or stop > self.rows:
+            stop = self.rows
+        pieces = []
+        k = max(bisect.bisect_right(self.firsts, start) - 1, 0)                    #chunk holding row start
+        while k < len(self.chunks) and self.chunks[k][0] < stop:
+            first = self.chunks[k][0]
+            pieces.append(self.chunkColumn(k, name)[max(start - first, 0):stop - first])
+            k = k + 1
+        if len(pieces) == 1:
+            return pieces[0]
+        if len(pieces) == 0:
+            return numpy.empty(0, dict(self.columns)[name])
+        return numpy.concatenate(pieces)
+
+    def close(self):
+        self.map.close()
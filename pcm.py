@@ -6,50 +6,599 @@
 
 import sys, argparse, logging
 import time
-from os import listdir
+import threading
+import queue
+import struct
+import io
+import mmap
+import hashlib
+from math import gcd
+from array import array
+from itertools import repeat
 from decimal import Decimal
+from fractions import Fraction
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
 from instruments import B2901A      #instruments.py
+import discovery                    #discovery.py
 
 
 # Gather our code in a main() function
 def main(args, loglevel):
     logging.basicConfig(format="%(levelname)s: %(message)s", level=loglevel)
 
-    devices = listdir("/dev/")                                 #get listing of contents of /dev directory
-    usbtmcdevices = list(s for s in devices if "usbtmc" in s)  #list all usbtmc* filenames in /dev
-    if args.mock:
-        print("Using MOCK device!")
-    if not args.mock and len(usbtmcdevices) < 1:
-        print("No USB TMC devices found; exiting.")
+    if args.compile:                                                                #compile only; no instrument needed
+        with open(args.compile, "wb") as outfile:
+            count = compilePCM(parsePCM(args.infile, 64, lambda wf: prepare(wf, args)), outfile)
+        print("Compiled " + str(count) + " operations to " + args.compile + ".")
         return
-    logging.debug("Found:" + str(usbtmcdevices))
+
+    if args.plan:                                                                   #dry run; no instrument needed
+        import simulator                                                            #simulator.py, for TimingModel
+        timing = simulator.TimingModel()
+        for setting in args.latency or []:
+            name, _, value = setting.partition("=")
+            if name not in vars(timing):                                            #parameters only, not methods
+                print("Unknown timing model parameter " + name + "; exiting.")
+                return
+            if not is_number(value):
+                print("Unusable value \"" + value + "\" for timing model parameter " + name + "; exiting.")
+                return
+            setattr(timing, name, float(value))
+        nsmus = max(len(args.device or []), len(args.serial or []), args.simulate, 1)
+        if args.infile is not sys.stdin and isCompiledPCM(args.infile.name):
+            ops = loadCompiledPCM(args.infile.name, nsmus)
+        else:
+            ops = parsePCM(args.infile, nsmus, lambda wf: prepare(wf, args))
+        plan = Plan(timing, args.list_format)
+        plan.run(ops)
+        plan.report()
+        return
+
+    simulators = []
     if args.mock:
-        dev = ""
+        print("Using MOCK device!")
+    if args.simulate:
+        import simulator                                                            #simulator.py
+        print("Using " + str(args.simulate) + " SIMULATED device(s)!")
+        for k in range(args.simulate):
+            simulators.append(simulator.SimulatedB2901A(timeScale=args.time_scale, serial="SIM" + str(k).zfill(5)))
+    idns = {}                                                                       #known identities, by path
+    if args.device:
+        devicepaths = args.device                                                   #explicitly chosen devices
+    elif args.mock:
+        devicepaths = ["/dev/"]
+    else:
+        found = discovery.discover([sim.path for sim in simulators] if simulators else None)
+        logging.debug("Found:" + str([(r["path"], r["idn"] or r["error"]) for r in found]))
+        found = discovery.matching(found, cls=B2901A, serials=args.serial)
+        if args.serial and len(found) < len(args.serial):
+            missing = set(args.serial) - set(r["serial"] for r in found)
+            print("No SMU found with serial number " + ", ".join(sorted(missing)) + "; exiting.")
+            return
+        if len(found) < 1:
+            print("No SMUs found; exiting.")
+            return
+        if not args.all and not args.serial and not simulators:
+            found = found[:1]                                                       #select first available match
+        devicepaths = [r["path"] for r in found]
+        idns = {r["path"]: r["idn"] for r in found}
+    logging.debug("Selecting:" + str(devicepaths))
+
+    tracer = None
+    if args.trace:
+        import tracing                                                              #tracing.py
+        tracer = tracing.Tracer(maxEvents=args.trace_events)
+    smus = []
+    for devicepath in devicepaths:
+        smu = B2901A(devicepath, mock=args.mock, timeout=args.timeout, idn=idns.get(devicepath))   #connect to SMU and reset it
+        smu.tracer = tracer
+        smu.reset()
+        if args.list_format != "ASCII":
+            smu.setListDataFormat(args.list_format)                                 #binary list uploads
+        smus.append(smu)
+    streams = None
+    if args.acquire:
+        import acquisition, measurementlog                                          #need NumPy
+        streams = []
+        for k, smu in enumerate(smus):
+            logname = args.acquire if len(smus) == 1 else args.acquire + "." + str(k)
+            stream = acquisition.TraceStream(smu)
+            stream.log = measurementlog.MeasurementLog(logname, stream.columns(),
+                {"idn": smu.idn, "device": smu.devicepath, "settings": smu.state, "elements": list(stream.elements)})
+            streams.append(stream)
+    station = Station(smus, align=args.align, streams=streams)
+
+    if args.infile is not sys.stdin and isCompiledPCM(args.infile.name):
+        ops = loadCompiledPCM(args.infile.name, len(smus))                          #precompiled; nothing to parse
+    else:
+        ops = parsePCM(args.infile, len(smus), lambda wf: prepare(wf, args))
+    if args.lookahead > 0:
+        ops = parseAhead(ops, args.lookahead)                                       #parse while the SMUs are busy
+
+    ln = 0
+    print("---------------------------")
+    for op in expandReplays(ops):
+        if op[0] == 'OUT':                                                          #output control
+            station.enableOutput(op[1], op[2])
+
+        elif op[0] == 'W':                                                          #waveform play
+            station.play(op[1], op[2], op[3])
+
+        elif op[0] == 'R':                                                          #replay
+            print("---------------------------")
+            print("Found REPLAY on line " + str(op[2]) + "; replaying " + str(op[3]) + " operations, " + str(op[1]) + " times.")
+            for r in op[4]:
+                station.play(r[1], r[2], r[3])                                      #replay the waveform
+            print("---------------------------")
+
+        elif op[0] == 'EOF':
+            ln = op[1]
+
+    print("Processed " + str(ln) + " input lines.")
+    station.report()
+    if streams is not None:
+        for stream in streams:
+            stream.log.trailer["settings"] = dict(stream.smu.state)                 #settings as last programmed
+            stream.log.close()
+    if tracer is not None:
+        tracer.dump(args.trace)
+        print("I/O trace written to " + args.trace + ".")
+    for smu in smus:
+        smu.close()
+    for sim in simulators:
+        sim.close()
+
+    # END
+
+class Station:
+    """The SMUs driven by one PCM script.  Each operation is carried out on the
+    selected SMUs in parallel, one thread per SMU, and completes on all of them
+    before the next operation starts.  With align, plays wait for every
+    selected SMU to finish loading before any of them starts its sweep.
+    Per-SMU throughput and the spread of sweep start times (skew) are
+    recorded for report().  If streams (one acquisition.TraceStream per SMU)
+    are given, measurements are acquired during every play."""
+    def __init__(self, smus, align=False, streams=None):
+        self.smus = smus
+        self.align = align
+        self.streams = streams
+        self.pool = ThreadPoolExecutor(max_workers=len(smus))
+        self.plays = [0] * len(smus)                                                #sweeps played, per SMU
+        self.points = [0] * len(smus)                                               #list points played, per SMU
+        self.busy = [0.0] * len(smus)                                               #time spent playing, per SMU
+        self.skews = []                                                             #start skew of each multi-SMU play
+
+    def enableOutput(self, en, targets=None):
+        if targets is None:
+            targets = range(len(self.smus))
+        list(self.pool.map(lambda k: self.smus[k].enableOutput(en), targets))
+
+    def play(self, wf, iterations, targets=None):
+        """Play waveform wf, iterations times, on each SMU in targets (default all)."""
+        if targets is None:
+            targets = range(len(self.smus))
+        barrier = None
+        if self.align and len(targets) > 1:
+            barrier = threading.Barrier(len(targets))
+
+        def job(k):
+            begin = time.perf_counter()
+            try:
+                stream = self.streams[k] if self.streams is not None else None
+                start = playWaveform(wf, self.smus[k], iterations, barrier, stream)
+            except BaseException:
+                if barrier is not None:
+                    barrier.abort()                                                 #don't leave the other SMUs waiting
+                raise
+            self.plays[k] = self.plays[k] + iterations
+            self.points[k] = self.points[k] + wf.length * iterations
+            self.busy[k] = self.busy[k] + time.perf_counter() - begin
+            return start
+
+        starts = list(self.pool.map(job, targets))
+        if len(starts) > 1:
+            self.skews.append(max(starts) - min(starts))
+
+    def report(self):
+        """Print per-SMU throughput and start skew."""
+        for k, smu in enumerate(self.smus):
+            rate = self.points[k] / self.busy[k] if self.busy[k] > 0 else 0
+            print("SMU " + str(k) + " (" + smu.devicepath + ", " + smu.sn + "): " + str(self.plays[k]) + " sweeps, " +
+                  str(self.points[k]) + " points in " + "%.3f" % self.busy[k] + " s (" + "%.0f" % rate + " points/s).")
+            if self.streams is not None:
+                print("SMU " + str(k) + " acquired " + str(self.streams[k].points) + " points.")
+        if len(self.skews) > 0:
+            print("Start skew over " + str(len(self.skews)) + " plays: mean " + "%.3f" % (sum(self.skews) / len(self.skews) * 1000) +
+                  " ms, worst " + "%.3f" % (max(self.skews) * 1000) + " ms.")
+
+
+class Plan:
+    """Dry run of a PCM script.  Every operation is played on a mock SMU whose
+    tracer is this object, so each message that would be sent is seen, and
+    nothing waits for sweeps.  A timing model (simulator.TimingModel) gives
+    the time each message takes to transfer and parse and each sweep to run,
+    from which the run's wall time and the gaps between consecutive sweeps
+    are predicted.  Host time is what the play code takes on this machine.
+    All SMUs are assumed to do the same, in parallel."""
+    def __init__(self, timing, listFormat="ASCII"):
+        self.timing = timing
+        with redirect_stdout(io.StringIO()):
+            self.smu = B2901A("", mock=True)
+            self.smu.reset()
+            if listFormat != "ASCII":
+                self.smu.setListDataFormat(listFormat)
+        self.smu.tracer = self
+        self.smu.waitForComplete = self.waitForComplete
+        self.settings = {"ARM:COUNT": "1", "TRIG:COUNT": "1", "TRIG:TIMER": "0"}
+        self.clock = 0.0                                                            #predicted wall time so far
+        self.busyUntil = 0.0                                                        #predicted end of sweeps queued
+        self.lastEnd = None
+        self.instrumentTime = 0.0                                                   #time spent sweeping
+        self.transferTime = 0.0                                                     #time spent on messages
+        self.hostTime = 0.0
+        self.gaps = []                                                              #(gap before a sweep, waveform id)
+        self.waveforms = {}                                                         #id -> dict of totals
+        self.playing = None                                                         #totals of waveform being played
+
+    #tracer interface, see tracing.py
+    def sent(self, instrument, message, began, ended):
+        import tracing                                                              #tracing.py
+        cost = self.timing.transferTime(len(message))
+        sweeps = []
+        pos = 0
+        for header, length in tracing.splitCommands(message):
+            arg = message[pos + len(header) + 1:pos + length - 1]
+            pos = pos + length
+            key = header.lstrip(":")
+            points = 0
+            if key == "LIST:VOLT":
+                if arg[:1] == b"#":
+                    digits = arg[1] - ord("0")
+                    points = int(arg[2:2 + digits]) // (4 if self.smu.listFormat == "REAL,32" else 8)
+                else:
+                    points = arg.count(b",") + 1
+            elif key in self.settings:
+                self.settings[key] = bytes(arg).decode().strip()
+            elif key == "INIT":
+                sweeps.append(int(self.settings["ARM:COUNT"]) * int(self.settings["TRIG:COUNT"]))
+            cost = cost + self.timing.parseTime(points, arg[:1] == b"#")
+        self.clock = self.clock + cost
+        self.transferTime = self.transferTime + cost
+        interval = float(self.settings["TRIG:TIMER"])
+        for points in sweeps:
+            start = max(self.clock + self.timing.triggerLatency, self.busyUntil)
+            if self.lastEnd is not None:
+                self.gaps.append((start - self.lastEnd, self.playing["id"] if self.playing else None))
+            self.busyUntil = start + points * interval
+            self.lastEnd = self.busyUntil
+            self.instrumentTime = self.instrumentTime + points * interval
+        if self.playing is not None:
+            self.playing["bytes"] = self.playing["bytes"] + len(message)
+            self.playing["transactions"] = self.playing["transactions"] + 1
+            self.playing["sweeps"] = self.playing["sweeps"] + len(sweeps)
+
+    def received(self, instrument, length, began, ended):
+        pass
+
+    def control(self, instrument, name, began, ended):
+        pass
+
+    def waitForComplete(self, estimate=0, timeout=None):
+        """Stands in for the SMU's: completes when the modeled sweeps end, plus
+        one status poll."""
+        self.clock = max(self.clock, self.busyUntil) + self.timing.transferTime(1)
+        return 0.0
+
+    def play(self, wf, iterations):
+        totals = self.waveforms.get(wf.id)
+        if totals is None:
+            totals = self.waveforms[wf.id] = {"id": wf.id, "points": wf.length, "tstep": wf.tstep, "runs": len(wf.runVolts),
+                "chunks": -(-wf.length // self.smu.maxListLength), "timingError": wf.timingError,
+                "plays": 0, "sweeps": 0, "bytes": 0, "transactions": 0, "instrument": 0.0}
+        self.playing = totals
+        begin = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            playWaveform(wf, self.smu, iterations)
+        self.hostTime = self.hostTime + time.perf_counter() - begin
+        totals["plays"] = totals["plays"] + iterations
+        totals["instrument"] = totals["instrument"] + float(wf.duration) * iterations
+        self.playing = None
+
+    def run(self, ops):
+        """Plays ops, as produced by parsePCM(), the way main() does."""
+        for op in expandReplays(ops):
+            if op[0] == 'OUT':
+                self.smu.enableOutput(op[1])
+            elif op[0] == 'W':
+                self.play(op[1], op[2])
+            elif op[0] == 'R':
+                for r in op[4]:
+                    self.play(r[1], r[2])
+        self.clock = max(self.clock, self.busyUntil)                                #run ends with the last sweep
+
+    def report(self):
+        print("Waveform   Points  Timestep (s)    Runs  Chunks   Plays  Sweeps  Upload (B)  Transactions  Instrument (s)")
+        for w in sorted(self.waveforms.values(), key=lambda w: w["id"]):
+            print("%8d %8d  %-12s %7d %7d %7d %7d %11d %13d %15.3f" % (w["id"], w["points"], w["tstep"], w["runs"],
+                  w["chunks"], w["plays"], w["sweeps"], w["bytes"], w["transactions"], w["instrument"]))
+        print("Total: " + str(self.smu.transfersOut) + " transactions, " + str(self.smu.bytesOut) + " bytes sent.")
+        print("Predicted wall time " + "%.3f" % self.clock + " s: sweeping " + "%.3f" % self.instrumentTime +
+              " s, transfers and parsing " + "%.3f" % self.transferTime + " s; host overhead here " +
+              "%.3f" % self.hostTime + " s.")
+        if len(self.gaps) > 0:
+            gap, wfid = max(self.gaps, key=lambda g: g[0])
+            print("Worst inter-sweep gap " + "%.2f" % (gap * 1000) + " ms, before a sweep of waveform " + str(wfid) +
+                  "; mean " + "%.2f" % (sum(g for g, k in self.gaps) / len(self.gaps) * 1000) + " ms.")
+        for w in sorted(self.waveforms.values(), key=lambda w: w["id"]):
+            if w["chunks"] > 1:
+                print("Warning: waveform " + str(w["id"]) + " exceeds the list length (" + str(self.smu.maxListLength) +
+                      " points) and plays as " + str(w["chunks"]) + " chunks, with a gap between each.")
+            if float(w["tstep"]) < self.smu.minTriggerInterval:
+                print("Warning: waveform " + str(w["id"]) + " timestep " + str(w["tstep"]) +
+                      " s is below the instrument's minimum trigger interval (" + str(self.smu.minTriggerInterval) + " s).")
+            if w["timingError"]:
+                print("Note: waveform " + str(w["id"]) + " timing is off by up to " + str(float(w["timingError"])) + ".")
+
+
+def expandReplays(ops):
+    """Passes on the operations of ops, as produced by parsePCM(), keeping the
+    record of plays that replays need.  Each replay ['R', repeats, line]
+    becomes
+        ['R', repeats, line, plays, replay]
+    where plays is the number of play operations played so far and replay
+    iterates over the W operations that carry out the replay, with
+    consecutive plays of the same waveform merged (see mergePlays())."""
+    history = []                                                                    #play operations performed so far, as a tree
+    for op in ops:
+        if op[0] == 'W':
+            history.append(op)                                                      #save a record for possible replay later
+        elif op[0] == 'R':
+            replay = mergePlays(iterPlays([repeatOps(history, op[1])]))
+            op = ['R', op[1], op[2], countPlays(history), replay]
+            history = [repeatOps(history, op[1] + 1)]                               #record the replay itself for later replays
+        yield op
+
+
+def repeatOps(ops, repeats):
+    """Returns an operation tree node that plays the list ops, repeats times:
+        ['SEQ', ops, repeats, plays]
+    where plays is the number of play operations the node expands to.  The
+    node refers to ops rather than copying it, so the caller must not
+    modify ops afterward.  A repeated single play becomes one play with
+    more iterations, and a repeated single node one node with more repeats."""
+    if len(ops) == 1:
+        op = ops[0]
+        if op[0] == 'W':
+            return ['W', op[1], op[2] * repeats, op[3]]
+        if op[0] == 'SEQ':
+            return ['SEQ', op[1], op[2] * repeats, op[3] * repeats]
+    return ['SEQ', ops, repeats, countPlays(ops) * repeats]
+
+
+def countPlays(ops):
+    """Number of play operations the list ops expands to."""
+    return sum(op[3] if op[0] == 'SEQ' else 1 for op in ops)
+
+
+def iterPlays(ops):
+    """Iterates over the play operations of a list that may contain 'SEQ'
+    nodes from repeatOps(), expanding the nodes as it goes."""
+    stack = [[ops, 0, 1]]                                                           #[list, next index, repeats left]
+    while len(stack) > 0:
+        frame = stack[-1]
+        if frame[1] == len(frame[0]):                                               #end of list
+            if frame[2] > 1:
+                frame[1] = 0
+                frame[2] = frame[2] - 1
+            else:
+                stack.pop()
+            continue
+        op = frame[0][frame[1]]
+        frame[1] = frame[1] + 1
+        if op[0] == 'SEQ':
+            stack.append([op[1], 0, op[2]])
+        else:
+            yield op
+
+
+def mergePlays(plays):
+    """Merges consecutive plays of the same waveform content on the same SMUs
+    into one play with the iterations summed, so the instrument can repeat the
+    sweep itself."""
+    pending = None
+    for op in plays:
+        if pending is not None and op[3] == pending[3] and op[1].tstep == pending[1].tstep and \
+                op[1].contentHash() == pending[1].contentHash():
+            pending[2] = pending[2] + op[2]
+            continue
+        if pending is not None:
+            yield pending
+        pending = list(op)                                                          #copy; iterations may grow
+    if pending is not None:
+        yield pending
+
+
+COMPLETION_MARGIN = 10.0                                                            #seconds allowed past a sweep estimate
+
+
+def completionTimeout(smu, estimate):
+    """Time to wait for sweeps estimated to take estimate seconds before
+    giving up: the estimate plus 10%, plus the SMU's timeout if set or else
+    COMPLETION_MARGIN.  A lost OPC or a sweep that never ends then raises
+    InstrumentTimeout instead of hanging."""
+    return estimate * 1.1 + (smu.timeout if smu.timeout is not None else COMPLETION_MARGIN)
+
+
+def playWaveform(wf, smu, iterations=1, barrier=None, stream=None):
+    """Play a waveform one or more times.  Repeats are done by the instrument,
+    using the arm count, in as few sweeps as its trigger count x arm count
+    limit allows.  If barrier (a threading.Barrier) is given, waits on it
+    after loading and before starting the sweeps.  If stream (an
+    acquisition.TraceStream) is given, measurements are acquired during each
+    sweep, and sweeps are started one at a time so none overruns the trace
+    buffer.  Returns the time (perf_counter) at which the sweeps were started."""
+    if wf.length > smu.maxListLength:                                               #too long for one list sweep?
+        return playChunkedWaveform(wf, smu, iterations, barrier, stream)
+    smu.prepareVoltageListSweep(wf, wf.tstep, compliance=0.1, key=wf.contentHash()) #prepare SMU for list sweep
+    smu.confirmVoltageList()                                                        #before *CLS empties the error queue
+    arms = max(min(iterations, smu.maxSweepPoints // max(wf.length, 1)), 1)         #repeats per sweep
+    sweeps = -(-iterations // arms)
+    print("Loaded waveform " + str(wf.id) + "; queuing " + str(iterations) + " repeats in " + str(sweeps) + " sweeps.")
+    if barrier is not None:
+        barrier.wait()                                                              #start together with other SMUs
+    start = None
+    remaining = iterations
+    while remaining > 0:
+        with smu.batch():
+            smu.clearStatus()                                                       #clear OPC left by previous play
+            while remaining > 0:
+                count = min(arms, remaining)
+                remaining = remaining - count
+                smu.setArmCount(count)
+                if stream is not None:
+                    stream.begin(wf.contentHash())
+                    smu.initiate(wait=False)                                        #one sweep; trace is read while it runs
+                    break
+                smu.initiate(monitor=(remaining == 0))                              #execute sweep on instrument
+        if start is None:
+            start = time.perf_counter()
+        playtime = float(wf.duration) * (iterations if stream is None else count)   #estimate sweep duration
+        print("Waiting for sweeps to complete, estimated " + str(playtime) + " seconds.")
+        if stream is not None:
+            actual = stream.wait(playtime, completionTimeout(smu, playtime))
+        else:
+            actual = smu.waitForComplete(playtime, completionTimeout(smu, playtime))
+        print("Sweeps completed in " + "%.3f" % actual + " seconds.")
+    return start
+
+
+def playChunkedWaveform(wf, smu, iterations=1, barrier=None, stream=None):
+    """Play a waveform that exceeds the instrument's list length as a series of
+    back-to-back list sweeps.  While one chunk executes, the next is expanded
+    and encoded on a worker thread, so only its upload (one batched transfer)
+    falls in the gap between the end of one sweep and the start of the next.
+    Reports the measured inter-chunk gaps.  barrier, stream and the return
+    value are as for playWaveform(); the time returned is the start of the
+    first chunk."""
+    def chunkSource():
+        for n in range(iterations):
+            yield from wf.chunks(smu.maxListLength)
+    chunks = chunkSource()
+
+    def encodeNext():                                                               #runs on worker thread
+        chunk = next(chunks, None)
+        if chunk is None:
+            return None
+        return smu.encodeVoltageList(chunk), len(chunk)
+
+    nchunks = -(-wf.length // smu.maxListLength) * iterations
+    print("Loaded waveform " + str(wf.id) + "; streaming " + str(nchunks) + " chunks (" + str(iterations) + " sweeps).")
+    first = next(chunks)
+    with smu.batch():
+        smu.prepareVoltageListSweep(first, wf.tstep, compliance=0.1)                #full setup with first chunk
+        smu.setArmCount(1)
+    smu.confirmVoltageList()
+    if barrier is not None:
+        barrier.wait()                                                              #start together with other SMUs
+    with smu.batch():
+        smu.clearStatus()
+        if stream is not None:
+            stream.begin(wf.contentHash())
+        smu.initiate(wait=(stream is None))                                         #no *WAI if the trace is read meanwhile
+    start = time.perf_counter()
+    points = len(first)
+    gaps = []
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        while True:
+            upcoming = pool.submit(encodeNext)                                      #prepare next chunk meanwhile
+            chunkTime = float(points * wf.tstep)
+            if stream is not None:
+                stream.wait(chunkTime, completionTimeout(smu, chunkTime))           #acquire during this chunk
+            else:
+                smu.waitForComplete(chunkTime, completionTimeout(smu, chunkTime))   #wait out this chunk
+            finished = time.perf_counter()
+            nextChunk = upcoming.result()
+            if nextChunk is None:
+                break
+            command, points = nextChunk
+            with smu.batch():                                                       #upload and start next chunk
+                smu.loadVoltageList(command)
+                smu.setTriggerCount(points)
+                smu.clearStatus()
+                if stream is not None:
+                    stream.begin(wf.contentHash())
+                smu.initiate(wait=(stream is None))
+            gaps.append(time.perf_counter() - finished)
+    if len(gaps) > 0:
+        print("Inter-chunk gap: min " + "%.2f" % (min(gaps) * 1000) + " ms, mean " +
+              "%.2f" % (sum(gaps) / len(gaps) * 1000) + " ms, max " + "%.2f" % (max(gaps) * 1000) + " ms.")
+    return start
+
+
+def prepare(wf, args):
+    """Compile a waveform for playing, as set up on the command line."""
+    if args.max_error is not None or args.max_rel_error is not None:
+        wf = optimizeWaveform(wf, args)                                             #trade timing accuracy for fewer points
+    wf.contentHash()                                                                #computed here, off the playback thread
+    return wf
+
+
+def optimizeWaveform(wf, args):
+    """Re-quantize a waveform onto the coarsest timebase allowed by the
+    timing error budget given on the command line."""
+    if args.max_rel_error is not None:
+        owf = wf.optimizeTimeStep(Decimal(args.max_rel_error), relative=True)
     else:
-        dev = usbtmcdevices[0]
-    devicepath = "/dev/" + dev                                  #select first available match
-    logging.debug("Selecting:" + str(devicepath))
+        owf = wf.optimizeTimeStep(Decimal(args.max_error))
+    if owf is not wf:
+        print("Waveform " + str(wf.id) + ": timestep " + str(wf.tstep) + " -> " + str(owf.tstep) +
+              ", " + str(wf.length) + " -> " + str(owf.length) + " points, max timing error " +
+              str(float(owf.timingError)) + (" (relative)" if args.max_rel_error is not None else " s"))
+    return owf
 
-    smu = B2901A(devicepath, mock=args.mock)                    #connect to SMU and reset it
-    smu.reset()
 
-    #Parse input file line by line.
-    #DEF n opens a new waveform n.  OUT <ON/OFF> controls output state.
-    #W n m plays waveform #n, m times.  A pair of numbers on a line is interpreted
-    #as [time, voltage] and added to the currently open waveform.
+def parsePCM(lines, nsmus, prepare=None):
+    """Parses PCM input line by line, yielding operations as they are complete:
+        ['DEF', id]                       waveform id defined
+        ['OUT', on, targets]              output on (True) or off
+        ['W', waveform, plays, targets]   play waveform, plays times
+        ['R', repeats, line]              replay everything played so far
+        ['EOF', lines]                    end of input
+    targets is the list of SMU numbers an operation applies to, or None for
+    all of them.  Waveforms
+    are passed through prepare() (if given) before being yielded.  A waveform
+    that has been yielded is never modified afterward; adding points to it
+    continues on a copy, so operations can be consumed while parsing goes on.
+
+    DEF n opens a new waveform n.  OUT <ON/OFF> controls output state.
+    W n m plays waveform #n, m times.  A pair of numbers on a line is
+    interpreted as [time, voltage] and added to the currently open waveform.
+    SMU k[,k...] directs following OUT and W operations to the listed SMUs
+    (numbered from 0 in command line order); SMU ALL directs them to every
+    SMU again.  Generator lines (RAMP, SINE, SQUARE, PRBS, CSV; see
+    generateSamples()) add a whole sequence of samples to the currently open
+    waveform at once."""
     waveforms = {}                                                                  #stores waveforms
     currentWaveform = 0
     waveforms[currentWaveform] = Waveform(currentWaveform)                          #create first waveform and store it
-    replay = []                                                                     #tracks play operations previously performed
+    played = set()                                                                  #ids of waveforms already yielded
+    targets = None                                                                  #SMUs that operations apply to; None is all
     ln = 0                                                                          #line number
-    print("---------------------------")
-    for line in args.infile.readlines():
+
+    def openWaveform():                                                             #current waveform, for adding points
+        if currentWaveform in played:                                               #may still be in use; copy on write
+            waveforms[currentWaveform] = waveforms[currentWaveform].copy()
+            played.discard(currentWaveform)
+        return waveforms[currentWaveform]
+
+    for line in lines:
         ln = ln + 1
         tokens = line.split()                                                       #split on whitespace
         if len(tokens) < 2:                                                         #skip blank lines and single-symbols
             logging.debug("Skipped input line " + str(ln) + ", insufficient input: " + str(tokens))
             continue
-        if tokens[0][0] == '#' or tokens[1][0] == '#':                                                     #skip comments
+        if tokens[0][0] == '#' or tokens[1][0] == '#':                              #skip comments
             continue
         if is_number(tokens[0]):                                                    #waveform data?
             if not is_number(tokens[1]):                                            #second parameter isn't a number also
@@ -57,78 +606,315 @@ def main(args, loglevel):
                 continue
             t = Decimal(tokens[0])                                                  #import as Decimal to preserve precision
             v = Decimal(tokens[1])
-            waveforms[currentWaveform].addPoint(t,v)                                #add datapoint to the currently open waveform
-
-        else:                                                                       #not waveform data, must be an operation
-            op = tokens[0]
-            if op == 'D' or op == 'DEF':                                            #Define-waveform operation
-                if not is_number(tokens[1]):                                        #Can't process a DEF with no ID number
-                    print("Error - waveform definition without ID on line " + str(ln))
-                    continue
-                idnum = int(tokens[1])
-                if idnum < 0:
-                    print("Error - waveform definition with negative ID on line " + str(ln))
-                    continue
-                waveforms[idnum] = Waveform(idnum)                                  #create and store a new waveform object
-                currentWaveform = idnum                                             #remember its location
-                logging.debug("Defined waveform " + str(idnum))
+            openWaveform().addPoint(t,v)                                            #add datapoint to the currently open waveform
+            continue
+
+        op = tokens[0]                                                              #not waveform data, must be an operation
+        if op.upper() in GENERATORS:                                                #generated waveform data
+            try:
+                step, volts = generateSamples(tokens)
+            except (ValueError, IndexError, ArithmeticError, OSError) as e:
+                print("Error - unusable " + op.upper() + " generator on line " + str(ln) + ": " + str(e))
                 continue
+            openWaveform().addSamples(step, volts)
+            logging.debug("Generated " + str(len(volts)) + " samples on line " + str(ln))
 
-            if op == 'OUT' or op == 'out':                                          #output control
-                if tokens[1] == 'ON' or tokens[1] == 'on':
-                    smu.enableOutput(True)
-                elif tokens[1] == 'OFF' or tokens[1] == 'off':
-                    smu.enableOutput(False)
+        elif op == 'D' or op == 'DEF':                                                #Define-waveform operation
+            if not is_number(tokens[1]):                                            #Can't process a DEF with no ID number
+                print("Error - waveform definition without ID on line " + str(ln))
+                continue
+            idnum = int(tokens[1])
+            if idnum < 0:
+                print("Error - waveform definition with negative ID on line " + str(ln))
                 continue
+            waveforms[idnum] = Waveform(idnum)                                      #create and store a new waveform object
+            played.discard(idnum)
+            currentWaveform = idnum                                                 #remember its location
+            logging.debug("Defined waveform " + str(idnum))
+            yield ['DEF', idnum]
 
-            if op == 'W' or op == 'w':                                              #waveform play command
-                if not is_number(tokens[1]):                                        #missing or non-numeric id number?
-                    print("Error - waveform operation missing ID on line " + str(ln))
-                    continue
-                idnum = int(tokens[1])
-                if idnum < 0 or idnum not in waveforms.keys():
-                    print("Error - waveform requested does not exist, on line " + str(ln))
-                    continue
-                wf = waveforms[idnum]                                               #select the waveform to play
-                plays = 1
-                if len(tokens) > 2 and is_number(tokens[2]):                        #additional parameter present?
-                    plays = int(tokens[2])                                          #it is number of iterations
-                    if plays < 1:
-                        plays = 1
-                playWaveform(wf, smu, iterations=plays)
-                replay.append(['W',wf,plays])                                       #save a record for possible replay later
+        elif op == 'SMU' or op == 'smu':                                            #select SMUs
+            if tokens[1] == 'ALL' or tokens[1] == 'all':
+                targets = None
                 continue
+            selected = ",".join(tokens[1:]).split(",")
+            if not all(k.isdigit() and int(k) < nsmus for k in selected if k):
+                print("Error - unknown SMU selected on line " + str(ln))
+                continue
+            targets = sorted(set(int(k) for k in selected if k))
+            logging.debug("Selected SMUs " + str(targets))
 
-            if op == 'R' or op == 'r':                                              #replay command
-                if not is_number(tokens[1]) or int(tokens[1]) < 1:                  #parameter is number of iterations
-                    print("Error - unusable replay count found on line " + str(ln))
-                    continue
-                repeats = int(tokens[1])
-                print("---------------------------")
-                print("Found REPLAY on line " + str(ln) + "; replaying " + str(len(replay)) + " operations, " + str(repeats) + " times.")
-                for n in range(repeats):
-                    for r in replay:
-                        if r[0] == 'W':                                             #entry describes a waveform play operation
-                            wf = r[1]
-                            iterations = r[2]
-                            playWaveform(wf, smu, iterations)                       #replay the waveform
-                    print("---------------------------")
-                for n in range(repeats):
-                    replay.extend(replay)                                           #record the replay operation itself for possible replay later
+        elif op == 'OUT' or op == 'out':                                            #output control
+            if tokens[1] == 'ON' or tokens[1] == 'on':
+                yield ['OUT', True, targets]
+            elif tokens[1] == 'OFF' or tokens[1] == 'off':
+                yield ['OUT', False, targets]
 
-    print("Processed " + str(ln) + " input lines.")
+        elif op == 'W' or op == 'w':                                                #waveform play command
+            if not is_number(tokens[1]):                                            #missing or non-numeric id number?
+                print("Error - waveform operation missing ID on line " + str(ln))
+                continue
+            idnum = int(tokens[1])
+            if idnum < 0 or idnum not in waveforms.keys():
+                print("Error - waveform requested does not exist, on line " + str(ln))
+                continue
+            wf = waveforms[idnum]                                                   #select the waveform to play
+            plays = 1
+            if len(tokens) > 2 and is_number(tokens[2]):                            #additional parameter present?
+                plays = int(tokens[2])                                              #it is number of iterations
+                if plays < 1:
+                    plays = 1
+            played.add(idnum)
+            if prepare is not None:
+                wf = prepare(wf)
+            yield ['W', wf, plays, targets]
+
+        elif op == 'R' or op == 'r':                                                #replay command
+            if not is_number(tokens[1]) or int(tokens[1]) < 1:                      #parameter is number of iterations
+                print("Error - unusable replay count found on line " + str(ln))
+                continue
+            yield ['R', int(tokens[1]), ln]
+
+    yield ['EOF', ln]
+
+
+GENERATORS = {                                                                      #usage of each generator
+    "RAMP":   "RAMP step duration v0 v1",
+    "SINE":   "SINE step duration amplitude frequency [offset [phase]]",
+    "SQUARE": "SQUARE step duration low high frequency [duty]",
+    "PRBS":   "PRBS step bits low high [order [seed]]",
+    "CSV":    "CSV step file [column]",
+}
+PRBS_TAPS = {7: 6, 9: 5, 11: 9, 15: 14, 23: 18, 31: 28}                            #x^order + x^tap + 1
+
+
+def generateSamples(tokens):
+    """Evaluates a generator line, split into tokens.  Returns (step, volts):
+    the sample duration (Decimal, seconds) and a NumPy array of sample
+    voltages, computed in bulk rather than point by point.  Generators:
+        RAMP step duration v0 v1            straight line from v0 to v1
+        SINE step duration amplitude frequency [offset [phase]]
+                                            phase in degrees
+        SQUARE step duration low high frequency [duty]
+                                            duty cycle 0-1, default 0.5
+        PRBS step bits low high [order [seed]]
+                                            pseudo-random bit sequence, bits
+                                            long, order 7 (default), 9, 11, 15,
+                                            23 or 31
+        CSV step file [column]              a column (default: the last) of a
+                                            comma-separated file
+    Durations are rounded to a whole number of samples.  Raises ValueError
+    or IndexError on unusable arguments.  Requires NumPy."""
+    import numpy                                                                    #optional dependency, only needed here
+    name = tokens[0].upper()
+    step = Decimal(tokens[1])
+    if step <= 0:
+        raise ValueError("step must be positive")
+    if name == "CSV":
+        data = numpy.loadtxt(tokens[2], delimiter=",", ndmin=2)
+        return step, data[:, int(tokens[3]) if len(tokens) > 3 else -1]
+    if name == "PRBS":
+        order = int(tokens[5]) if len(tokens) > 5 else 7
+        seed = int(tokens[6]) if len(tokens) > 6 else 1
+        bits = prbs(order, int(tokens[2]), seed)
+        return step, numpy.where(bits, float(tokens[4]), float(tokens[3]))
+    n = int((Decimal(tokens[2]) / step).to_integral_value())
+    if n < 1:
+        raise ValueError("duration shorter than one step")
+    p = [float(x) for x in tokens[3:]]
+    t = numpy.arange(n) * float(step)
+    if name == "RAMP":
+        return step, numpy.linspace(p[0], p[1], n)
+    if name == "SINE":
+        offset = p[2] if len(p) > 2 else 0.0
+        phase = numpy.radians(p[3]) if len(p) > 3 else 0.0
+        return step, offset + p[0] * numpy.sin(2 * numpy.pi * p[1] * t + phase)
+    if name == "SQUARE":                                                            #phase exact, so edges don't jitter
+        cycles = Fraction(step) * Fraction(tokens[5])                               #cycles per sample
+        duty = min(max(Fraction(tokens[6]) if len(tokens) > 6 else Fraction(1, 2), Fraction(0)), Fraction(1))
+        num, den = cycles.numerator % cycles.denominator, cycles.denominator
+        k = numpy.arange(n)
+        if den * max(num, duty.denominator) >= 2 ** 62:
+            k = k.astype(object)                                                    #Python ints; would overflow int64
+        phase = k % den * num % den                                                 #phase of each sample, in 1/den cycles
+        return step, numpy.where(phase * duty.denominator < duty.numerator * den, p[1], p[0])
+    raise ValueError("unknown generator " + name)
+
+
+def prbs(order, count, seed=1):
+    """Returns count bits (a NumPy bool array) of the maximal-length sequence
+    of the given order, starting from the state given by seed's low bits.
+    Uses b[k] = b[k-order] ^ b[k-tap]; since squaring the polynomial doubles
+    both lags, each pass computes a block as long as the current tap lag, so
+    the number of NumPy operations grows only logarithmically with count."""
+    import numpy                                                                    #optional dependency, only needed here
+    if order not in PRBS_TAPS:
+        raise ValueError("PRBS order must be one of " + ", ".join(str(k) for k in sorted(PRBS_TAPS)))
+    if count < 1:
+        raise ValueError("PRBS needs at least one bit")
+    tap = PRBS_TAPS[order]
+    seed = seed % (2 ** order)
+    if seed == 0:
+        raise ValueError("PRBS seed must be nonzero in its low " + str(order) + " bits")
+    b = numpy.empty(max(count, order), dtype=bool)
+    b[:order] = [(seed >> k) & 1 for k in range(order)]
+    k = order
+    scale = 1
+    while k < count:
+        if k >= 2 * order * scale:
+            scale = scale * 2                                                       #enough history for doubled lags
+        lagN, lagT = order * scale, tap * scale
+        n = min(lagT, count - k)
+        b[k:k + n] = b[k - lagN:k - lagN + n] ^ b[k - lagT:k - lagT + n]
+        k = k + n
+    return b[:count]
 
-    # END
 
-def playWaveform(wf, smu, iterations=1):
-    """Play a waveform one or more times."""
-    smu.prepareVoltageListSweep(wf.vlist, wf.tstep, compliance=0.1)                 #prepare SMU for list sweep
-    print("Loaded waveform " + str(wf.id) + "; queuing " + str(iterations) + " sweeps.")
-    for n in range(iterations):
-        smu.initiate()                                                              #execute sweep on instrument
-    playtime = float(wf.duration) * iterations * 0.99                               #estimate total sweep duration, minus a hair
-    print("Waiting " + str(playtime) + " seconds.")
-    time.sleep(playtime)
+def parseAhead(ops, depth):
+    """Runs generator ops on a worker thread, at most depth items ahead of the
+    consumer, and yields its items.  Exceptions raised by ops are re-raised
+    in the consumer."""
+    pipe = queue.Queue(maxsize=depth)
+    finished = object()
+
+    def produce():
+        try:
+            for op in ops:
+                pipe.put(op)
+            pipe.put(finished)
+        except BaseException as e:
+            pipe.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = pipe.get()
+        if item is finished:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+#Compiled PCM file layout.  All integers little-endian (native order must match):
+#  header    magic "PCMC", u16 version, u16 reserved, u32 waveform count,
+#            u32 operation count, u32 input line count, u32 reserved,
+#            u64 waveform table offset, u64 operation table offset
+#  data      per waveform, its run tick counts (u64) then run voltages (f64),
+#            8-byte aligned
+#  waveforms per waveform: u32 id, u32 reserved, u64 run count, u64 timestep
+#            numerator, u64 timestep denominator, u64 ticks offset,
+#            u64 voltages offset, f64 timing error, 20-byte SHA-1 content hash,
+#            4 bytes padding
+#  ops       per operation: u8 code (1 OUT, 2 W, 3 R), u8 output state,
+#            u16 reserved, u32 waveform index or replay count,
+#            u32 plays or source line, u32 reserved, u64 SMU mask (0 = all)
+PCMC_MAGIC = b"PCMC"
+PCMC_VERSION = 1
+PCMC_HEADER = struct.Struct("<4sHHIIIIQQ")
+PCMC_WAVEFORM = struct.Struct("<IIQQQQQd20s4x")
+PCMC_OP = struct.Struct("<BBHIIIQ")
+
+
+def compilePCM(ops, outfile):
+    """Writes the operations produced by parsePCM() to binary file outfile (an
+    open binary file), for later playback with loadCompiledPCM().  Waveform
+    data is written as it is first played, so only the operation list is
+    held in memory.  Returns the number of operations written."""
+    if sys.byteorder != "little":
+        raise ValueError("Compiled PCM files are little-endian")
+    outfile.write(bytes(PCMC_HEADER.size))                                         #placeholder, rewritten at end
+    offset = PCMC_HEADER.size
+    waveforms = {}                                                                  #(id, timestep, content hash) -> table index
+    table = []
+    records = []
+    lines = 0
+    for op in ops:
+        if op[0] == 'W':
+            wf = op[1]
+            key = (wf.id, wf.tstep, wf.contentHash())                               #not id(wf); played copies may be freed
+            if key not in waveforms:                                                #first play; write its data
+                ticks = array('Q', wf.runTicks).tobytes()
+                volts = array('d', wf.runVolts).tobytes()
+                outfile.write(ticks)
+                outfile.write(volts)
+                step = Fraction(wf.tstep)
+                table.append(PCMC_WAVEFORM.pack(wf.id, 0, len(wf.runVolts), step.numerator, step.denominator,
+                                                offset, offset + len(ticks), float(wf.timingError),
+                                                bytes.fromhex(wf.contentHash())))
+                offset = offset + len(ticks) + len(volts)
+                waveforms[key] = len(table) - 1
+            records.append(PCMC_OP.pack(2, 0, 0, waveforms[key], op[2], 0, targetMask(op[3])))
+        elif op[0] == 'OUT':
+            records.append(PCMC_OP.pack(1, int(op[1]), 0, 0, 0, 0, targetMask(op[2])))
+        elif op[0] == 'R':
+            records.append(PCMC_OP.pack(3, 0, 0, op[1], op[2], 0, 0))
+        elif op[0] == 'EOF':
+            lines = op[1]
+    tableOffset = offset
+    outfile.write(b"".join(table))
+    opsOffset = tableOffset + len(table) * PCMC_WAVEFORM.size
+    outfile.write(b"".join(records))
+    outfile.seek(0)
+    outfile.write(PCMC_HEADER.pack(PCMC_MAGIC, PCMC_VERSION, 0, len(table), len(records), lines, 0,
+                                   tableOffset, opsOffset))
+    return len(records)
+
+
+def targetMask(targets):
+    """SMU target list as a bit mask for compiled files; 0 means all SMUs."""
+    if targets is None:
+        return 0
+    mask = 0
+    for k in targets:
+        mask = mask | (1 << k)
+    return mask
+
+
+def isCompiledPCM(path):
+    """True if the file at path is a compiled PCM file."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(PCMC_MAGIC)) == PCMC_MAGIC
+    except OSError:
+        return False
+
+
+def loadCompiledPCM(path, nsmus):
+    """Memory-maps a file written by compilePCM() and yields its operations in
+    the same form as parsePCM().  Waveform runs are read-only views into the
+    mapping, so no per-point Python objects are created; the list upload
+    encodes them run by run."""
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, _, nwaveforms, nops, lines, _, tableOffset, opsOffset = PCMC_HEADER.unpack_from(mm, 0)
+    if magic != PCMC_MAGIC or version != PCMC_VERSION:
+        raise ValueError(path + " is not a version " + str(PCMC_VERSION) + " compiled PCM file")
+    data = memoryview(mm)
+    waveforms = []
+    for n in range(nwaveforms):
+        num, _, runs, stepNum, stepDen, ticksOffset, voltsOffset, err, digest = \
+            PCMC_WAVEFORM.unpack_from(mm, tableOffset + n * PCMC_WAVEFORM.size)
+        wf = Waveform.fromRuns(num, data[ticksOffset:ticksOffset + 8 * runs].cast('Q'),
+                               data[voltsOffset:voltsOffset + 8 * runs].cast('d'),
+                               Decimal(stepNum) / Decimal(stepDen))
+        wf.timingError = err
+        wf._hash = digest.hex()
+        waveforms.append(wf)
+    for n in range(nops):
+        code, on, _, arg, arg2, _, mask = PCMC_OP.unpack_from(mm, opsOffset + n * PCMC_OP.size)
+        targets = None
+        if mask != 0:
+            targets = [k for k in range(mask.bit_length()) if mask & (1 << k)]
+            if targets[-1] >= nsmus:
+                print("Error - operation " + str(n) + " selects SMU " + str(targets[-1]) + ", which is not connected")
+                continue
+        if code == 1:
+            yield ['OUT', bool(on), targets]
+        elif code == 2:
+            yield ['W', waveforms[arg], arg2, targets]
+        elif code == 3:
+            yield ['R', arg, arg2]
+    yield ['EOF', lines]
 
 
 def is_number(s):
@@ -140,44 +926,202 @@ def is_number(s):
 
 
 class Waveform:
-    """Represents one playable waveform on the SMU."""
+    """Represents one playable waveform on the SMU.  The waveform is held in
+    run-length form: runTicks[i] timebase steps at voltage runVolts[i], with
+    adjacent runs of equal voltage merged.  Tick counts are integers on a
+    running common timebase, so adding a point only rescales existing runs
+    when the timebase actually changes.  Per-step values are only produced on
+    demand, by iterVoltages() or vlist.  A Waveform is itself a sized iterable
+    of voltages, so it can be handed straight to the instrument's list upload."""
     def __init__(self, num):
         self.id = num
-        self.points = []
-        self.vlist = []
+        self.runTicks = array('Q')                              #length of each run, in timebase steps
+        self.runVolts = array('d')                              #voltage of each run
+        self.denominator = 1                                    #running LCM of point time denominators
+        self.tstep = Decimal('1')
+        self.length = 0                                         #total length, in timebase steps
         self.duration = 0
-        pass
+        self.timingError = 0                                    #worst run duration error vs. the input
+        self._optimized = None                                  #cached result of optimizeTimeStep()
+        self._hash = None                                       #cached result of contentHash()
 
     def addPoint(self, time, voltage):
         """Add a duration (seconds) and level (volts)"""
-        self.points.append([time,voltage])                      #add recent point
-        self.tstep = self.findCommonTimeStep(self.points)       #calculate new timebase
-        vlist = []
-        for [t,v] in self.points:
-            copies = int(t / self.tstep)                        #number of repetitions needed
-            for n in range(copies):
-                vlist.append(v)                                 #add that number of copies of voltage
-        self.vlist = vlist                                      #save result
-        self.duration = len(self.vlist) * self.tstep            #calculate total play time
-
-    def findCommonTimeStep(self, tv):
-        """Takes list of time,value Decimal pairs. Returns a time step which is the
-        largest time step that can be used to exactly represent all of the pairs in
-        the input list."""
-        import functools                                             #needed for reduce()
-        def gcd(a,b):                                               #greatest common denominator of 2 integers
-            while b:
-                a,b = b, a % b
-            return a
-        def lcm(a,b):                                               #least common multiple of two integers
-            return a * b // gcd(a,b)
-        def lcmm(arglist):                                          #least common multiple of a list of integers
-            return functools.reduce(lcm, arglist)
-        times = [t for [t,v] in tv]                                 #extract list of times
-        denominators = [t.as_integer_ratio()[1] for t in times]     #get integer representation denominator of each
-        lcm_denom = lcmm(denominators)                              #LCM of list of denominators
-        tstep = Decimal('1') / Decimal(lcm_denom)
-        return tstep
+        num, den = time.as_integer_ratio()                      #exact rational representation of time
+        lcm = self.denominator * den // gcd(self.denominator, den)
+        if lcm != self.denominator:                             #timebase must get finer
+            scale = lcm // self.denominator
+            self.runTicks = array('Q', (k * scale for k in self.runTicks))   #rescale existing runs to new timebase
+            self.length = self.length * scale
+            self.denominator = lcm
+            self.tstep = Decimal('1') / Decimal(lcm)
+        copies = max(num * (lcm // den), 0)                     #number of repetitions needed
+        if copies > 0:
+            v = float(voltage)
+            if len(self.runVolts) > 0 and self.runVolts[-1] == v:
+                self.runTicks[-1] += copies                     #extend previous run at same level
+            else:
+                self.runTicks.append(copies)
+                self.runVolts.append(v)
+            self.length = self.length + copies
+        self.duration = self.length * self.tstep                #calculate total play time
+        self._optimized = None
+        self._hash = None
+
+    def addSamples(self, step, volts):
+        """Add a sequence of samples, each lasting step seconds (Decimal), with
+        levels volts (a NumPy array or any sequence).  The samples are merged
+        into runs with NumPy, without a Python operation per sample.
+        Requires NumPy."""
+        import numpy                                                                #optional dependency, only needed here
+        volts = numpy.asarray(volts, dtype=numpy.float64)
+        if len(volts) == 0:
+            return
+        num, den = step.as_integer_ratio()
+        lcm = self.denominator * den // gcd(self.denominator, den)
+        if lcm != self.denominator:                             #timebase must get finer
+            scale = lcm // self.denominator
+            self.runTicks = array('Q', (k * scale for k in self.runTicks))
+            self.length = self.length * scale
+            self.denominator = lcm
+            self.tstep = Decimal('1') / Decimal(lcm)
+        ticks = num * (lcm // den)                              #timebase steps per sample
+        starts = numpy.concatenate(([0], numpy.flatnonzero(volts[1:] != volts[:-1]) + 1))
+        counts = numpy.diff(numpy.append(starts, len(volts))) * ticks
+        levels = volts[starts]
+        if len(self.runVolts) > 0 and self.runVolts[-1] == levels[0]:
+            self.runTicks[-1] += int(counts[0])                 #extend previous run at same level
+            counts, levels = counts[1:], levels[1:]
+        self.runTicks.frombytes(counts.astype(numpy.uint64).tobytes())
+        self.runVolts.frombytes(levels.tobytes())
+        self.length = self.length + len(volts) * ticks
+        self.duration = self.length * self.tstep
+        self._optimized = None
+        self._hash = None
+
+    def optimizeTimeStep(self, maxError, relative=False, resolution=Decimal('0.000001'), maxDivisor=1000):
+        """Search for the coarsest timestep that represents every run to within
+        maxError, either in seconds or, if relative is True, as a fraction of
+        each run's duration.  Candidate steps are integer fractions of the run
+        durations, rounded to a multiple of resolution (the instrument's timer
+        resolution).  Returns a new Waveform on the chosen timebase with its
+        achieved worst-case error in timingError, or this waveform unchanged if
+        no coarser step fits the budget.  The returned waveform is final; it
+        does not accept further points."""
+        key = (maxError, relative, resolution, maxDivisor)
+        if self._optimized is not None and self._optimized[0] == key:
+            return self._optimized[1]
+        exact = Fraction(1, self.denominator)
+        durations = sorted(set(Fraction(k, self.denominator) for k in self.runTicks))   #distinct run durations
+        budget = Fraction(maxError)
+        quantum = Fraction(resolution)
+
+        def worstError(step):                                   #worst run error on this step, or None if over budget
+            worst = 0
+            for d in durations:
+                err = abs(max(round(d / step), 1) * step - d)
+                if relative:
+                    err = err / d
+                if err > budget:
+                    return None
+                worst = max(worst, err)
+            return worst
+
+        best = self
+        if len(durations) > 0:
+            shortest = durations[0]
+            stepmax = shortest * (1 + budget) if relative else shortest + budget    #every run needs at least one step
+            candidates = set()
+            for d in durations[:32]:                            #shortest runs constrain the step the most
+                for n in range(max(int(d / stepmax), 1), maxDivisor + 1):
+                    step = round(d / n / quantum) * quantum     #snap to timer resolution
+                    if step <= exact:
+                        break
+                    candidates.add(step)
+            for step in sorted(candidates, reverse=True):
+                err = worstError(step)
+                if err is not None:
+                    best = Waveform.fromRuns(self.id,           #timebase need not be 1/n, so built directly
+                        array('Q', (max(round(Fraction(k, self.denominator) / step), 1) for k in self.runTicks)),
+                        array('d', self.runVolts), Decimal(step.numerator) / Decimal(step.denominator))
+                    best.timingError = err
+                    break
+        self._optimized = (key, best)
+        return best
+
+    def copy(self):
+        """Returns an independent copy of this waveform."""
+        wf = Waveform(self.id)
+        wf.runTicks = array('Q', self.runTicks)
+        wf.runVolts = array('d', self.runVolts)
+        wf.denominator = self.denominator
+        wf.tstep = self.tstep
+        wf.length = self.length
+        wf.duration = self.duration
+        wf.timingError = self.timingError
+        return wf
+
+    def contentHash(self):
+        """Returns a hash identifying the expanded voltage list.  Runs are kept
+        merged, so equal lists always have equal runs."""
+        if self._hash is None:
+            h = hashlib.sha1(self.runTicks.tobytes())
+            h.update(self.runVolts.tobytes())
+            self._hash = h.hexdigest()
+        return self._hash
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.iterVoltages()
+
+    def runs(self):
+        """Iterate over (ticks, voltage) pairs."""
+        return zip(self.runTicks, self.runVolts)
+
+    def iterVoltages(self):
+        """Iterate over the waveform one timebase step at a time."""
+        for copies, v in self.runs():
+            yield from repeat(v, copies)
+
+    def chunks(self, maxlen):
+        """Iterate over the waveform as consecutive pieces of at most maxlen
+        steps each, as final Waveforms on the same timebase.  Runs are split
+        across piece boundaries as needed."""
+        ticks, volts, size = array('Q'), array('d'), 0
+        for copies, v in self.runs():
+            while copies > 0:
+                n = min(copies, maxlen - size)
+                ticks.append(n)
+                volts.append(v)
+                size = size + n
+                copies = copies - n
+                if size == maxlen:
+                    yield Waveform.fromRuns(self.id, ticks, volts, self.tstep)
+                    ticks, volts, size = array('Q'), array('d'), 0
+        if size > 0:
+            yield Waveform.fromRuns(self.id, ticks, volts, self.tstep)
+
+    @classmethod
+    def fromRuns(cls, num, ticks, volts, tstep):
+        """Returns a final waveform (one that accepts no further points) made
+        from existing run arrays.  ticks and volts may be any sequences of ints
+        and floats, including read-only memoryviews; they are not copied."""
+        wf = cls(num)
+        wf.runTicks = ticks
+        wf.runVolts = volts
+        wf.denominator = None
+        wf.tstep = tstep
+        wf.length = sum(ticks)
+        wf.duration = wf.length * tstep
+        return wf
+
+    @property
+    def vlist(self):
+        """Voltage list expanded to one entry per timebase step.  Built anew
+        on each access; use iterVoltages() where a list is not needed."""
+        return list(self.iterVoltages())
 
 
 
@@ -195,7 +1139,8 @@ if __name__ == '__main__':
     # add argument processors
     parser.add_argument( "infile",
         nargs='?', type=argparse.FileType('r'), default=sys.stdin,
-        help="Input PCM file (or standard input if ommitted)",
+        help="Input PCM file (or standard input if ommitted).  May be a file \
+              compiled with --compile.",
         metavar = "input file")
 
     parser.add_argument( "--verbose", "-v",
@@ -206,6 +1151,88 @@ if __name__ == '__main__':
         help="Use mock instrument. Note: does not reply to requests!",
         action="store_true")
 
+    parser.add_argument( "--compile", "-c",
+        help="Compile the input to a binary file for fast loading, instead of \
+              playing it.  Play the result by giving it as the input file.",
+        metavar="OUTFILE")
+
+    parser.add_argument( "--plan", "-p",
+        help="Dry run: parse the input and report what playing it would send \
+              and how long it would take, without an instrument or waiting",
+        action="store_true")
+
+    parser.add_argument( "--latency",
+        help="With --plan, set a timing model parameter (see \
+              simulator.TimingModel), e.g. transferLatency=0.002.  Repeatable.",
+        action="append", metavar="NAME=SECONDS")
+
+    parser.add_argument( "--device", "-d",
+        help="Path of an SMU to use, e.g. /dev/usbtmc1.  Repeat to drive several \
+              SMUs in parallel.  Default is the first B2901A found.",
+        action="append", metavar="PATH")
+
+    parser.add_argument( "--serial", "-s",
+        help="Serial number of an SMU to use, as in its *IDN? reply.  Repeat \
+              to drive several SMUs in parallel.",
+        action="append", metavar="SERIAL")
+
+    parser.add_argument( "--all", "-a",
+        help="Use every B2901A found",
+        action="store_true")
+
+    parser.add_argument( "--align",
+        help="With several SMUs, start each play on all of them together",
+        action="store_true")
+
+    parser.add_argument( "--lookahead",
+        help="Number of operations to parse ahead of playback on a separate \
+              thread (default 8, 0 to parse in step with playback)",
+        type=int, default=8, metavar="N")
+
+    parser.add_argument( "--acquire",
+        help="Acquire measurements throughout every play and write them to \
+              this measurement log file (see measurementlog.py; with several \
+              SMUs, one file per SMU with suffix .0, .1, ...).  Requires NumPy.",
+        metavar="LOGFILE")
+
+    parser.add_argument( "--simulate",
+        help="Play to N simulated SMUs (see simulator.py) instead of real ones \
+              (default 1)",
+        type=int, nargs="?", const=1, default=0, metavar="N")
+
+    parser.add_argument( "--time-scale",
+        help="With --simulate, scale simulated instrument timing by this factor \
+              (default 1, 0 for no delays)",
+        type=float, default=1.0, metavar="FACTOR")
+
+    parser.add_argument( "--timeout",
+        help="Give up on (and recover from) any instrument reply that takes \
+              longer than this many seconds (default: the driver's timeout)",
+        type=float, metavar="SECONDS")
+
+    parser.add_argument( "--trace",
+        help="Record instrument I/O (per-command counts, bytes and latency \
+              histograms, see tracing.py) and write it to this JSON file",
+        metavar="FILE")
+
+    parser.add_argument( "--trace-events",
+        help="With --trace, also log up to N individual transfers (default 0)",
+        type=int, default=0, metavar="N")
+
+    parser.add_argument( "--list-format",
+        help="Data format for voltage list uploads (default ASCII)",
+        choices=["ASCII", "REAL,32", "REAL,64"], default="ASCII")
+
+    budget = parser.add_mutually_exclusive_group()
+    budget.add_argument( "--max-error",
+        help="Allow each waveform segment's duration to be off by up to this many \
+              seconds, in exchange for the coarsest (shortest list) timestep that fits",
+        metavar="SECONDS")
+
+    budget.add_argument( "--max-rel-error",
+        help="As --max-error, but as a fraction of each segment's duration",
+        metavar="FRACTION")
+
     args = parser.parse_args()
 
     # Setup logging
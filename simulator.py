@@ -0,0 +1,490 @@
+import os
+import pty
+import tty
+import time
+import math
+import select
+import struct
+import threading
+from itertools import cycle, islice
+
+
+"""Simulated instruments for testing and benchmarking without hardware.  Each
+simulator serves a pseudo-terminal whose path is passed to the instrument
+classes in place of /dev/usbtmc*, so the real file I/O path is exercised:
+
+    sim = SimulatedB2901A(timeScale=0)
+    smu = B2901A(sim.path)
+    ...
+    sim.close()
+
+The simulators parse the SCPI subset used by instruments.py, keep the
+settings and status registers, and produce data.  Transfers, command parsing
+and sweeps take the time given by a TimingModel, multiplied by timeScale (0
+for no delays at all).  A pty can't carry the USBTMC control requests, so
+the instrument classes fall back to *STB? for serial polls, and each
+simulator answers *STB? at once even while a sweep runs, as a serial poll
+would be.  Commands in a compound message are all taken as absolute."""
+
+
+class TimingModel:
+    """Estimates of how long an instrument takes to move and process messages.
+    Used by the simulators, and by anything else predicting run times (e.g.
+    a dry run of a PCM script).  Defaults are rough figures for a B2901A on
+    USB 2.0."""
+    def __init__(self, transferLatency=0.001, bytesPerSecond=1e6, commandTime=0.0003,
+                 asciiPointTime=0.00003, binaryPointTime=0.000002, triggerLatency=0.003):
+        self.transferLatency = transferLatency          #per message, each direction, seconds
+        self.bytesPerSecond = bytesPerSecond            #bulk transfer rate
+        self.commandTime = commandTime                  #instrument's parse time per command
+        self.asciiPointTime = asciiPointTime            #parse time per list value, ASCII
+        self.binaryPointTime = binaryPointTime          #parse time per list value, REAL,32/64
+        self.triggerLatency = triggerLatency            #from :INIT to the first trigger
+
+    def transferTime(self, nbytes):
+        """Time to transfer one message of nbytes bytes."""
+        return self.transferLatency + nbytes / self.bytesPerSecond
+
+    def parseTime(self, points=0, binary=False):
+        """Time the instrument spends on one command carrying points list values."""
+        return self.commandTime + points * (self.binaryPointTime if binary else self.asciiPointTime)
+
+    def sweepTime(self, points, interval):
+        """Time from :INIT to the end of a sweep of points triggers interval apart."""
+        return self.triggerLatency + points * interval
+
+
+def shortForm(mnemonic):
+    """Returns the SCPI short form of a mnemonic, e.g. SOURCE -> SOUR, DELAY -> DEL."""
+    mnemonic = mnemonic.upper().rstrip("0123456789")
+    if len(mnemonic) <= 4:
+        return mnemonic
+    if mnemonic[3] in "AEIOU":
+        return mnemonic[:3]
+    return mnemonic[:4]
+
+
+def normalize(header):
+    """Returns a command header in canonical form: short-form mnemonics
+    joined by ':', without leading colon, query mark or the optional SOUR
+    node.  Common commands (*XXX) are only upper-cased."""
+    header = header.strip().rstrip("?").upper()
+    if header.startswith("*"):
+        return header
+    nodes = [shortForm(m) for m in header.lstrip(":").split(":")]
+    if nodes[0] == "SOUR" and len(nodes) > 1:
+        nodes = nodes[1:]
+    return ":".join(nodes)
+
+
+class SimulatedInstrument:
+    """Base class for simulated instruments.  Handles the pty, message
+    framing (including definite-length block arguments), IEEE 488.2 common
+    commands and the error queue.  Settings not handled by a method are
+    stored, and returned when queried."""
+    idn = "SIMULATED,INSTRUMENT,0,0"
+
+    def __init__(self, timing=None, timeScale=1.0):
+        self.timing = timing if timing is not None else TimingModel()
+        self.timeScale = timeScale
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.messages = 0                               #statistics: messages received
+        self.commands = 0                               #commands executed
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.handlers = {"*IDN": self.idnQuery, "*RST": self.reset, "*CLS": self.clearStatus,
+                         "*ESE": self.eventStatusEnable, "*SRE": self.serviceRequestEnable,
+                         "*ESR": self.eventStatusQuery, "*STB": self.statusByteQuery,
+                         "*OPC": self.operationComplete, "*WAI": self.waitToContinue,
+                         "SYST:ERR": self.errorQuery}
+        self.holdUntil = 0.0                            #*WAI: commands wait until then
+        self.held = []                                  #commands waiting for holdUntil
+        self.reset()
+        self.ese = 0
+        self.sre = 0
+        self._running = True
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops serving and releases the pty."""
+        self._running = False
+        self._thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def reset(self, arg=None):
+        self.settings = {}
+        self.errors = []
+        self.esr = 0
+        self.opcAt = None                               #time *OPC completes
+        self.busyUntil = 0.0                            #end of operations in progress
+
+    def delay(self, seconds):
+        if seconds * self.timeScale > 0:
+            time.sleep(seconds * self.timeScale)
+
+    def error(self, code, message):
+        self.errors.append(str(code) + ",\"" + message + "\"")
+
+    #MESSAGE handling
+    def serve(self):
+        poller = select.poll()
+        poller.register(self.master, select.POLLIN)
+        buf = bytearray()
+        while self._running:
+            wait = 100
+            if self.held:
+                wait = min(max((self.holdUntil - time.perf_counter()) * 1000, 0), wait)
+            ready = poller.poll(wait)
+            self.release()
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 65536)
+            except OSError:
+                break                                   #closed
+            buf.extend(data)
+            while True:
+                message = self.parseMessage(buf)
+                if message is None:
+                    break                               #incomplete, wait for the rest
+                commands, length = message
+                del buf[:length]
+                self.messages = self.messages + 1
+                self.bytesIn = self.bytesIn + length
+                self.delay(self.timing.transferTime(length))
+                for header, arg in commands:
+                    self.dispatch(header, arg)
+
+    def parseMessage(self, buf):
+        """Splits the first complete message in buf into (header, argument)
+        pairs.  Returns (commands, message length), or None if buf holds no
+        complete message.  Block arguments are returned as bytes, others as
+        str, absent ones as None."""
+        commands = []
+        i = 0
+        n = len(buf)
+        while True:
+            j = i
+            while j < n and buf[j] not in b" ;\n":
+                j = j + 1
+            if j >= n:
+                return None
+            header = bytes(buf[i:j]).decode().strip()
+            arg = None
+            if buf[j] == ord(" "):
+                j = j + 1
+                if j < n and buf[j] == ord("#"):        #definite-length block
+                    if j + 2 > n:
+                        return None
+                    digits = buf[j + 1] - ord("0")
+                    start = j + 2 + digits
+                    if start > n:
+                        return None
+                    length = int(buf[j + 2:start])
+                    if start + length >= n:
+                        return None
+                    arg = bytes(buf[start:start + length])
+                    j = start + length
+                else:
+                    k = j
+                    while k < n and buf[k] not in b";\n":
+                        k = k + 1
+                    if k >= n:
+                        return None
+                    arg = bytes(buf[j:k]).decode().strip()
+                    j = k
+            if header:
+                commands.append((header, arg))
+            if buf[j] == ord("\n"):
+                return commands, j + 1
+            i = j + 1
+
+    def dispatch(self, header, arg):
+        """Executes a command, or holds it (after any already held) while a
+        *WAI is in effect.  *STB? is never held: it stands in for the serial
+        poll, which the USBTMC driver does outside the message stream."""
+        if (self.held or time.perf_counter() < self.holdUntil) and normalize(header) != "*STB":
+            self.held.append((header, arg))
+        else:
+            self.execute(header, arg)
+
+    def release(self):
+        """Executes the held commands once the *WAI they wait for is over."""
+        while self.held and time.perf_counter() >= self.holdUntil:
+            header, arg = self.held.pop(0)
+            self.execute(header, arg)                   #may be another *WAI
+
+    def execute(self, header, arg):
+        self.commands = self.commands + 1
+        key = normalize(header)
+        query = header.rstrip().endswith("?")
+        handler = self.handlers.get(key)
+        if handler is not None:
+            result = handler(arg)
+        elif query:
+            result = self.settings.get(key)
+            if result is None:
+                self.error(-113, "Undefined header")
+        else:
+            self.delay(self.timing.parseTime())
+            self.settings[key] = arg
+            result = None
+        if query and result is not None:
+            self.reply(result)
+
+    def reply(self, data):
+        """Sends a response, str or bytes, with terminator."""
+        if isinstance(data, str):
+            data = data.encode()
+        data = data + b"\n"
+        self.delay(self.timing.transferTime(len(data)))
+        self.bytesOut = self.bytesOut + len(data)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def waitUntilIdle(self):
+        """Holds a reply until operations in progress finish, as *WAI would."""
+        remaining = self.busyUntil - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    #COMMON commands
+    def idnQuery(self, arg):
+        return self.idn
+
+    def clearStatus(self, arg):
+        self.esr = 0
+        self.opcAt = None
+        self.errors = []
+
+    def eventStatusEnable(self, arg):
+        if arg is None:
+            return str(self.ese)
+        self.ese = int(arg)
+
+    def serviceRequestEnable(self, arg):
+        if arg is None:
+            return str(self.sre)
+        self.sre = int(arg)
+
+    def updateStatus(self):
+        if self.opcAt is not None and time.perf_counter() >= self.opcAt:
+            self.esr = self.esr | 0x01                  #operation complete
+            self.opcAt = None
+
+    def eventStatusQuery(self, arg):
+        self.updateStatus()
+        esr = self.esr
+        self.esr = 0
+        return str(esr)
+
+    def statusByteQuery(self, arg):
+        self.updateStatus()
+        stb = 0
+        if self.errors:
+            stb = stb | 0x04                            #error queue not empty
+        if self.esr & self.ese:
+            stb = stb | 0x20                            #event summary
+        if stb & self.sre:
+            stb = stb | 0x40                            #master summary
+        return str(stb)
+
+    def operationComplete(self, arg):
+        if arg is None:
+            self.opcAt = max(self.busyUntil, time.perf_counter())
+            return None
+        self.waitUntilIdle()                            #*OPC? answers when done
+        return "1"
+
+    def waitToContinue(self, arg):
+        self.holdUntil = self.busyUntil                 #later commands are held, see dispatch()
+
+    def errorQuery(self, arg):
+        if self.errors:
+            return self.errors.pop(0)
+        return "+0,\"No error\""
+
+
+class SimulatedB2901A(SimulatedInstrument):
+    """Simulated Keysight B2901A SMU sourcing into a resistive load of
+    resistance ohms.  Supports list and fixed voltage sweeps on the timer
+    trigger, with arm count; the trace buffer; :FETC:ARR?, :TRAC:DATA? and
+    :MEAS? in ASCII or REAL,32/64 format.  Enforces the list length and
+    sweep point limits, queuing an error instead."""
+    maxListLength = 2500
+    maxSweepPoints = 100000
+    maxTracePoints = 100000
+
+    def __init__(self, timing=None, timeScale=1.0, serial="SIM00001", resistance=1000.0):
+        self.idn = "Keysight Technologies,B2901A," + serial + ",3.4.2011.5100"
+        self.resistance = resistance
+        super().__init__(timing, timeScale)
+        self.handlers.update({"LIST:VOLT": self.listVoltage, "INIT": self.initiate, "MEAS": self.measure,
+                              "FETC:ARR": self.fetchArray, "TRAC:CLE": self.traceClear,
+                              "TRAC:POIN:ACT": self.tracePointsQuery, "TRAC:DATA": self.traceData})
+
+    def reset(self, arg=None):
+        super().reset()
+        self.settings.update({"FORM:DATA": "ASCII", "FORM:BORD": "NORM",
+                              "FORM:ELEM:SENS": "VOLT,CURR,RES,TIME,STAT,SOUR",
+                              "VOLT": "0", "VOLT:MODE": "FIX", "TRIG:COUN": "1", "ARM:COUN": "1",
+                              "TRIG:TIM": "2E-5", "TRAC:POIN": str(self.maxTracePoints), "TRAC:FEED:CONT": "NEV"})
+        self.voltageList = [0.0]
+        self.results = []                               #rows (volt, curr, time, status) of the last sweep
+        self.trace = []                                 #(time stored, row)
+
+    def decode(self, arg):
+        """Returns the values of a list argument, ASCII or block."""
+        if isinstance(arg, str):
+            return [float(v) for v in arg.split(",")]
+        size = 4 if self.settings["FORM:DATA"] == "REAL,32" else 8
+        order = ">" if self.settings["FORM:BORD"] == "NORM" else "<"
+        return list(struct.unpack(order + str(len(arg) // size) + ("f" if size == 4 else "d"), arg))
+
+    def encode(self, values):
+        """Formats response values in the current data format."""
+        fmt = self.settings["FORM:DATA"]
+        if fmt == "ASCII":
+            return ",".join("%+.6E" % v for v in values)
+        code = "f" if fmt == "REAL,32" else "d"
+        order = ">" if self.settings["FORM:BORD"] == "NORM" else "<"
+        data = struct.pack(order + str(len(values)) + code, *values)
+        length = str(len(data)).encode()
+        return b"#" + str(len(length)).encode() + length + data
+
+    def listVoltage(self, arg):
+        if arg is None:
+            return self.encode(self.voltageList)
+        binary = isinstance(arg, bytes)
+        values = self.decode(arg)
+        self.delay(self.timing.parseTime(len(values), binary))
+        if len(values) > self.maxListLength:
+            self.error(-223, "Too much data")
+            return None
+        self.voltageList = values
+
+    def initiate(self, arg):
+        triggers = int(float(self.settings["TRIG:COUN"]))
+        arms = int(float(self.settings["ARM:COUN"]))
+        if triggers * arms > self.maxSweepPoints:
+            self.error(-221, "Settings conflict")
+            return None
+        interval = float(self.settings["TRIG:TIM"])
+        if self.settings["VOLT:MODE"] == "LIST":
+            volts = list(islice(cycle(self.voltageList), triggers)) * arms
+        else:
+            volts = [float(self.settings["VOLT"])] * (triggers * arms)
+        start = max(self.busyUntil, time.perf_counter()) + self.timing.triggerLatency * self.timeScale
+        self.results = [(v, v / self.resistance, k * interval, 0.0) for k, v in enumerate(volts)]
+        self.busyUntil = start + len(volts) * interval * self.timeScale
+        if self.settings["TRAC:FEED:CONT"] == "NEXT":
+            room = int(self.settings["TRAC:POIN"]) - len(self.trace)
+            for k, row in enumerate(self.results[:max(room, 0)]):
+                self.trace.append((start + (k + 1) * interval * self.timeScale, row))
+
+    def select(self, rows):
+        """Returns the values of the sense elements selected by :FORM:ELEM:SENS
+        for rows, point by point."""
+        columns = {"VOLT": 0, "CURR": 1, "TIME": 2, "STAT": 3}
+        values = []
+        for row in rows:
+            for name in self.settings["FORM:ELEM:SENS"].split(","):
+                name = name.strip().upper()
+                if name == "RES":
+                    values.append(self.resistance)
+                elif name == "SOUR":
+                    values.append(row[0])
+                else:
+                    values.append(row[columns[name]])
+        return values
+
+    def measure(self, arg):
+        self.waitUntilIdle()
+        v = self.voltageList[0] if self.settings["VOLT:MODE"] == "LIST" else float(self.settings["VOLT"])
+        return self.encode(self.select([(v, v / self.resistance, 0.0, 0.0)]))
+
+    def fetchArray(self, arg):
+        self.waitUntilIdle()
+        return self.encode(self.select(self.results))
+
+    def traceClear(self, arg):
+        self.trace = []
+
+    def stored(self):
+        now = time.perf_counter()
+        return sum(1 for t, row in self.trace if t <= now)
+
+    def tracePointsQuery(self, arg):
+        return str(self.stored())
+
+    def traceData(self, arg):
+        rows = [row for t, row in self.trace[:self.stored()]]
+        if arg:
+            offset, size = [int(v) for v in arg.split(",")]
+            rows = rows[offset:offset + size]
+        return self.encode(self.select(rows))
+
+
+class SimulatedMSO2102A(SimulatedInstrument):
+    """Simulated Rigol MSO2102A oscilloscope showing a sine wave of
+    frequency Hz on each channel.  Supports the waveform readout commands
+    (:WAV:SOUR, MODE, FORM BYTE, STAR, STOP, PRE?, DATA?) for screen and raw
+    memory data."""
+    screenPoints = 1400
+    memoryDepth = 140000
+    maxBytePoints = 250000
+
+    def __init__(self, timing=None, timeScale=1.0, serial="SIM00001", frequency=1000.0):
+        self.idn = "RIGOL TECHNOLOGIES,MSO2102A," + serial + ",00.02.01.00.00"
+        self.sampleInterval = 1e-6
+        self.memory = {}
+        for channel in (1, 2):
+            amplitude = 100 / channel
+            self.memory[channel] = bytes(int(127.5 + amplitude * math.sin(2 * math.pi * frequency * k * self.sampleInterval))
+                                         for k in range(self.memoryDepth))
+        super().__init__(timing, timeScale)
+        self.handlers.update({"RUN": self.run, "STOP": self.stop, "SING": self.stop,
+                              "WAV:PRE": self.preamble, "WAV:DATA": self.waveformData})
+
+    def reset(self, arg=None):
+        super().reset()
+        self.settings.update({"WAV:SOUR": "CHAN1", "WAV:MODE": "NORM", "WAV:FORM": "BYTE",
+                              "WAV:STAR": "1", "WAV:STOP": str(self.screenPoints)})
+        self.running = True
+
+    def run(self, arg):
+        self.running = True
+
+    def stop(self, arg):
+        self.running = False
+
+    def view(self):
+        """Returns (data, sample interval) for the current source and mode."""
+        data = self.memory[int(self.settings["WAV:SOUR"][-1])]
+        raw = self.settings["WAV:MODE"] == "RAW" or (self.settings["WAV:MODE"] == "MAX" and not self.running)
+        if raw:
+            return data, self.sampleInterval
+        step = self.memoryDepth // self.screenPoints
+        return data[::step], self.sampleInterval * step
+
+    def preamble(self, arg):
+        data, interval = self.view()
+        mode = {"NORM": 0, "MAX": 1, "RAW": 2}[self.settings["WAV:MODE"]]
+        return ",".join(str(v) for v in [0, mode, len(data), 1, interval, 0.0, 0, 0.01, 0, 127])
+
+    def waveformData(self, arg):
+        if self.settings["WAV:MODE"] == "RAW" and self.running:
+            self.error(-221, "Settings conflict")
+            return b"#10"
+        data, interval = self.view()
+        start = int(self.settings["WAV:STAR"])
+        stop = min(int(self.settings["WAV:STOP"]), len(data), start + self.maxBytePoints - 1)
+        data = data[start - 1:stop]
+        length = str(len(data)).encode()
+        return b"#9" + length.zfill(9) + data
@@ -1,26 +1,23 @@
 from instruments import B2901A
-from os import listdir
+import discovery
 
 """Test script to verify that I have communication with SMU working"""
 
 voltage_list = list(range(5))
 tstep = 1
 
-devices = listdir("/dev/")           #get listing of contents of /dev directory
-usbtmcdevices = list(s for s in devices if "usbtmc" in s)  #list all usbtmc* filenames in /dev
+smus = discovery.matching(discovery.discover(), cls=B2901A)     #probe all USB TMC devices
 
-if len(usbtmcdevices) > 0:
-    #print("Found:", usbtmcdevices)
-    #print("Selecting:", usbtmcdevices[0])
-    devicepath = "/dev/" + usbtmcdevices[0] #select first available match
+if len(smus) > 0:
+    #print("Found:", smus)
+    #print("Selecting:", smus[0]["path"])
     found = True
 else:
-    print("No USB TMC devices found!")
-    devicepath = ""
+    print("No B2901A SMUs found!")
     found = False
 
 if found:
-    smu = B2901A(devicepath)
+    smu = discovery.connect(smus[0])     #select first available match
     smu.reset()
     smu.pulse()
     smu.pulse()
@@ -0,0 +1,170 @@
+import json
+import math
+import time
+import threading
+
+
+"""Instrumentation of instrument I/O.  Assign a Tracer to the tracer attribute
+of one or more instruments; it is then told about every transfer and ioctl,
+and aggregates them per SCPI command header:
+
+    tracer = Tracer()
+    smu.tracer = tracer
+    ...
+    tracer.dump("run.trace.json")
+
+For each header it counts commands, bytes sent, and the time spent sending
+them (a message's write time is shared among its commands by size), and for
+queries the round trip from sending to having read the reply.  Times are
+kept in histograms with power-of-two buckets from 1 us.  Instruments keep
+plain counters of transfers, bytes and system calls whether or not a tracer
+is set; without one, the only other cost is a test for None per transfer."""
+
+
+class Histogram:
+    """Distribution of durations, in power-of-two buckets: bucket 0 holds
+    values below 1 us, bucket k values from 2^(k-1) to 2^k us."""
+    def __init__(self):
+        self.buckets = []
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        k = 0 if us < 1 else int(math.log2(us)) + 1
+        if k >= len(self.buckets):
+            self.buckets.extend([0] * (k + 1 - len(self.buckets)))
+        self.buckets[k] = self.buckets[k] + 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, p):
+        """Upper bound (seconds) of the bucket holding the p-th percentile."""
+        if self.count == 0:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            seen = seen + n
+            if seen >= rank:
+                return min(2 ** k * 1e-6, self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "total_s": self.total,
+                "mean_s": self.total / self.count if self.count else None,
+                "min_s": self.min, "p50_s": self.percentile(50), "p99_s": self.percentile(99),
+                "max_s": self.max, "buckets_us_log2": self.buckets}
+
+
+class CommandStats:
+    """What was sent for one command header."""
+    def __init__(self):
+        self.count = 0
+        self.bytesOut = 0
+        self.send = Histogram()                         #share of message write time
+        self.roundTrip = Histogram()                    #queries: write to reply read
+
+    def summary(self):
+        result = {"count": self.count, "bytes_out": self.bytesOut, "send": self.send.summary()}
+        if self.roundTrip.count:
+            result["round_trip"] = self.roundTrip.summary()
+        return result
+
+
+def splitCommands(message):
+    """Returns (header, length) for each command of a message, skipping over
+    definite-length block arguments.  Headers are upper-cased."""
+    commands = []
+    begin = 0
+    i = 0
+    n = len(message)
+    while i <= n:
+        c = message[i] if i < n else ord(";")
+        if c == ord("#") and i > 0 and message[i - 1] == ord(" ") and i + 1 < n:
+            digits = message[i + 1] - ord("0")
+            i = i + 2 + digits + int(message[i + 2:i + 2 + digits] or 0)
+            continue
+        if c == ord(";") or c == ord("\n"):
+            command = message[begin:i].strip()
+            if command:
+                commands.append((bytes(command.split(b" ", 1)[0]).decode(errors="replace").upper(), i - begin + 1))
+            begin = i + 1
+        i = i + 1
+    return commands
+
+
+class Tracer:
+    """Collects I/O events from instruments (see Instrument.tracer).  If
+    maxEvents is nonzero, also keeps a log of up to that many raw events,
+    (time, device, kind, name, bytes, seconds), for the trace file.  May be
+    shared by instruments used from different threads."""
+    def __init__(self, maxEvents=0):
+        self.commands = {}                              #header -> CommandStats
+        self.controls = {}                              #ioctl name -> Histogram
+        self.reads = Histogram()
+        self.maxEvents = maxEvents
+        self.events = []
+        self.instruments = {}                           #devicepath -> instrument
+        self._pending = {}                              #devicepath -> (query header, time sent)
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    def _event(self, instrument, kind, name, length, began, ended):
+        if len(self.events) < self.maxEvents:
+            self.events.append((began - self.started, instrument.devicepath, kind, name, length, ended - began))
+
+    def sent(self, instrument, message, began, ended):
+        commands = splitCommands(message)
+        with self._lock:
+            self.instruments[instrument.devicepath] = instrument
+            for header, length in commands:
+                stats = self.commands.get(header)
+                if stats is None:
+                    stats = self.commands[header] = CommandStats()
+                stats.count = stats.count + 1
+                stats.bytesOut = stats.bytesOut + length
+                stats.send.add((ended - began) * length / max(len(message), 1))
+            if commands and commands[-1][0].endswith("?"):
+                self._pending[instrument.devicepath] = (commands[-1][0], began)
+            self._event(instrument, "write", commands[0][0] if len(commands) == 1 else str(len(commands)) + " commands",
+                        len(message), began, ended)
+
+    def received(self, instrument, length, began, ended):
+        with self._lock:
+            self.instruments[instrument.devicepath] = instrument
+            self.reads.add(ended - began)
+            pending = self._pending.pop(instrument.devicepath, None)
+            if pending is not None:
+                self.commands[pending[0]].roundTrip.add(ended - pending[1])
+            self._event(instrument, "read", pending[0] if pending is not None else "", length, began, ended)
+
+    def control(self, instrument, name, began, ended):
+        with self._lock:
+            self.instruments[instrument.devicepath] = instrument
+            histogram = self.controls.get(name)
+            if histogram is None:
+                histogram = self.controls[name] = Histogram()
+            histogram.add(ended - began)
+            self._event(instrument, "ioctl", name, 0, began, ended)
+
+    def report(self):
+        """Returns everything collected as a dict."""
+        with self._lock:
+            return {"duration_s": time.perf_counter() - self.started,
+                    "instruments": {path: {"idn": i.idn, "transfers_out": i.transfersOut, "transfers_in": i.transfersIn,
+                                           "bytes_out": i.bytesOut, "bytes_in": i.bytesIn, "syscalls": i.syscalls}
+                                    for path, i in self.instruments.items()},
+                    "commands": {header: stats.summary() for header, stats in sorted(self.commands.items())},
+                    "ioctls": {name: h.summary() for name, h in sorted(self.controls.items())},
+                    "reads": self.reads.summary(),
+                    "events": [list(e) for e in self.events]}
+
+    def dump(self, path):
+        """Writes report() to path as JSON."""
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=1)